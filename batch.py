@@ -0,0 +1,127 @@
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from flask import Blueprint, Response, jsonify, request
+
+from metacache import cache_key
+from streaming import attachment_header
+from tracing import in_context
+
+MAX_BATCH = int(os.environ.get("TKDL_MAX_BATCH", "50"))
+# Batch videos downloaded at the same time, across all batches.
+BATCH_WORKERS = int(os.environ.get("TKDL_BATCH_WORKERS", "8"))
+READ_SIZE = 256 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+
+
+class _ZipSink:
+    """
+    Write-only file for ZipFile that collects output between yields.
+    Having no seek/tell makes zipfile write streaming-friendly data
+    descriptors instead of patching headers afterwards.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def read_urls():
+    """URLs from a JSON {"urls": [...]} body or a newline/space separated `urls` form field."""
+    payload = request.get_json(silent=True) or {}
+    urls = payload.get("urls")
+    if urls is None:
+        urls = re.split(r"\s+", request.form.get("urls", ""))
+    return [u.strip() for u in urls if u and u.strip()]
+
+
+def zip_stream(urls, fetch):
+    """
+    Yield a ZIP (stored, no compression) of the videos for `urls`.
+    `fetch(url)` returns the local path of the downloaded video. Downloads
+    run concurrently and each entry is written as soon as its video is
+    ready; failures are listed in errors.txt at the end.
+    """
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True)
+    futures = {_executor.submit(in_context(fetch), url): url for url in urls}
+    written = set()
+    errors = []
+    try:
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                path = future.result()
+                src = open(path, "rb")
+            except Exception as e:
+                errors.append(f"{url}\t{e}")
+                continue
+            name = os.path.basename(path)
+            if name in written:
+                src.close()
+                continue
+            written.add(name)
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with src, archive.open(info, mode="w", force_zip64=True) as dest:
+                while True:
+                    data = src.read(READ_SIZE)
+                    if not data:
+                        break
+                    dest.write(data)
+                    yield sink.drain()
+        if errors:
+            archive.writestr("errors.txt", "\n".join(errors) + "\n")
+        archive.close()
+        yield sink.drain()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def batch_blueprint(fetch, sanitize=lambda url, expand=True: url):
+    """
+    POST /batch with several URLs -> streamed ZIP of the videos. The URLs
+    are only checked up front (`sanitize(url, expand=False)`); short links
+    are expanded by the download workers, in parallel with the downloads.
+    """
+    bp = Blueprint("batch", __name__)
+
+    def expand_and_fetch(url):
+        return fetch(sanitize(url))
+
+    @bp.route("/batch", methods=["POST"])
+    def batch_download():
+        urls = {}
+        for url in read_urls():
+            url = sanitize(url, expand=False)
+            if url:
+                # Same video under another @name or short link: zip it once.
+                urls.setdefault(cache_key(url), url)
+        urls = list(urls.values())
+        if not urls:
+            return jsonify({"error": "No TikTok URLs given"}), 400
+        if len(urls) > MAX_BATCH:
+            return jsonify({"error": f"At most {MAX_BATCH} URLs per batch"}), 400
+        return Response(
+            zip_stream(urls, expand_and_fetch),
+            mimetype="application/zip",
+            headers={"Content-Disposition": attachment_header("tiktok-videos.zip")},
+        )
+
+    return bp
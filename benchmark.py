@@ -0,0 +1,445 @@
+"""
+Load-test a tkdl variant against local stand-ins for TikWM, SnapTik and
+the video CDN, so no third-party service is touched.
+
+    python benchmark.py tkdl1 --concurrency 16 --requests 400
+    python benchmark.py tkdl_async --latency 0.2 --bandwidth 2MB --fail-rate 0.05
+
+    # large-buffer I/O vs the old 8 KB reads, serving cached 50 MB files
+    python benchmark.py tkdl1 --size 50MB --videos 4 --bandwidth 0 --latency 0 \
+        --no-preview --env TKDL_STREAM=0 --env TKDL_MAX_CHUNK=8192
+
+The variant runs in a subprocess with its providers pointed at the
+stand-in (TKDL_TIKWM_API / TKDL_SNAPTIK_API; yt-dlp is disabled since it
+can only talk to tiktok.com). Clients alternate /preview and the
+variant's download flow over --videos distinct videos and the report
+gives req/s, latency and time-to-first-byte percentiles, bytes moved and
+the server's resident memory.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urljoin, urlparse
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Synthetic video IDs start with this, so their cached files are easy to clean up.
+ID_PREFIX = "79990000"
+
+# How each variant is driven: request encoding and what /download answers with.
+#   link     JSON {"download_url"} to GET
+#   redirect 302 to the file
+#   body     the video itself
+#   meta     <meta refresh> pointing at the video
+VARIANTS = {
+    "tkdl": {"encoding": "json", "download": "/download", "flow": "link"},
+    "tkdl1": {"encoding": "form", "download": "/", "flow": "redirect"},
+    "tkdl2": {"encoding": "form", "download": "/", "flow": "redirect"},
+    "tkdl4": {"encoding": "form", "download": "/download", "flow": "body"},
+    "tkdl5": {"encoding": "form", "download": "/download", "flow": "meta"},
+    "tkdl-dmode": {"encoding": "json", "download": "/download", "flow": "body"},
+    "tkdlmerged": {"encoding": "json", "download": "/download", "flow": "body"},
+    "tkdl_async": {"encoding": "json", "download": "/download", "flow": "link"},
+}
+
+
+def parse_size(text):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)B?", text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"bad size: {text}")
+    return int(float(match.group(1)) * {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[match.group(2)])
+
+
+# -------- Stand-in upstream -------- #
+
+class Upstream:
+    """Knobs shared by the fake TikWM, SnapTik and CDN handlers."""
+
+    def __init__(self, latency, bandwidth, fail_rate, video_size):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.video_size = video_size
+        self.base = None
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def fails(self):
+        return random.random() < self.fail_rate
+
+
+def make_handler(upstream):
+    chunk = bytes(range(256)) * 256  # 64 KiB of filler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _metadata(self, url):
+            video_id = (re.search(r"/video/(\d+)", url or "") or [None, "0"])[1]
+            return {
+                "play": f"{upstream.base}/video/{video_id}.mp4",
+                "cover": f"{upstream.base}/cover/{video_id}.jpg",
+                "title": f"bench video {video_id}",
+                "author": {"unique_id": "bench"},
+            }
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode())
+            if urlparse(self.path).path != "/api/":
+                return self._json({"error": "not found"}, 404)
+            upstream.count("tikwm")
+            time.sleep(upstream.latency)
+            if upstream.fails():
+                return self._json({"code": -1, "msg": "rate limited"})
+            self._json({"code": 0, "data": self._metadata(form.get("url", [""])[0])})
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path == "/api/v1/fetch":
+                upstream.count("snaptik")
+                time.sleep(upstream.latency)
+                if upstream.fails():
+                    return self._json({"error": "busy"}, 503)
+                meta = self._metadata(parse_qs(parsed.query).get("url", [""])[0])
+                return self._json({"video": {"urls": [meta["play"]]}, "cover": meta["cover"]})
+            if parsed.path.startswith("/cover/"):
+                upstream.count("cover")
+                body = b"\xff\xd8\xff\xe0" + b"\0" * 2048
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                return self.wfile.write(body)
+            if parsed.path.startswith("/video/"):
+                return self._video()
+            self._json({"error": "not found"}, 404)
+
+        def _video(self):
+            upstream.count("cdn")
+            time.sleep(upstream.latency)
+            if upstream.fails():
+                return self._json({"error": "cdn error"}, 503)
+            size = upstream.video_size
+            start, end = 0, size - 1
+            match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or end), end)
+                else:
+                    start = max(0, size - int(match.group(2)))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            remaining = end - start + 1
+            started = time.monotonic()
+            sent = 0
+            try:
+                while remaining > 0:
+                    data = chunk[:min(len(chunk), remaining)]
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                    sent += len(data)
+                    if upstream.bandwidth:
+                        # Sleep until this much data "should" have taken to send.
+                        ahead = sent / upstream.bandwidth - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return Handler
+
+
+def start_upstream(upstream):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(upstream))
+    server.daemon_threads = True
+    upstream.base = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# -------- Target app -------- #
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(variant, port, upstream, extra_env, workers=1):
+    env = dict(os.environ)
+    env.update({
+        "TKDL_TIKWM_API": f"{upstream.base}/api/",
+        "TKDL_SNAPTIK_API": f"{upstream.base}/api/v1/fetch",
+        "TKDL_PROVIDERS": "tikwm,snaptik",
+        "TKDL_TRACE_LOG": "0",
+        # Every benchmark client is 127.0.0.1 and the stand-ins don't throttle.
+        "TKDL_CLIENT_RATE": "0",
+        "TKDL_UPSTREAM_RATES": "",
+        # The load generator stands in for a proxy, each client with its own address.
+        "TKDL_TRUSTED_PROXIES": "1",
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.update(extra_env)
+    if workers > 1:
+        # serve.py's multi-process mode, with its shared state in a scratch file.
+        env.setdefault("TKDL_STATE_DB", os.path.join(BASE_DIR, f".bench-state-{port}.db"))
+        cmd = [sys.executable, "serve.py", variant, "--workers", str(workers), "--port", str(port)]
+    elif variant == "tkdl_async":
+        code = f"import uvicorn, tkdl_async; uvicorn.run(tkdl_async.app, port={port}, log_level='warning')"
+    else:
+        code = (
+            "import importlib, logging; logging.getLogger('werkzeug').setLevel(logging.ERROR); "
+            f"importlib.import_module({variant!r}).app.run(port={port}, threaded=True)"
+        )
+    if workers <= 1:
+        cmd = [sys.executable, "-c", code]
+    # Workers log every request to stderr; nobody drains the pipe mid-run.
+    stderr = subprocess.PIPE if workers <= 1 else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=stderr, text=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"{variant} exited during start-up:\n{proc.stderr.read() if proc.stderr else ''}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"{variant} did not start listening on port {port}")
+
+
+def rss_kb(pid, field="VmRSS"):
+    """Resident memory of `pid` and its child processes in KiB (Linux /proc; None elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            total = next((int(line.split()[1]) for line in f if line.startswith(field + ":")), None)
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return None
+    for child in children:
+        total = (total or 0) + (rss_kb(child, field) or 0)
+    return total
+
+
+def cleanup_files():
+    for folder in ("static/downloads", "downloads"):
+        path = os.path.join(BASE_DIR, folder)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if name.startswith(ID_PREFIX):
+                    os.remove(os.path.join(path, name))
+    for name in os.listdir(BASE_DIR):
+        if name.startswith(".bench-state-"):
+            os.remove(os.path.join(BASE_DIR, name))
+
+
+# -------- Load generator -------- #
+
+class Client:
+    _ids = itertools.count(1)
+
+    def __init__(self, base, spec):
+        self.base = base
+        self.spec = spec
+        self.session = requests.Session()
+        # An address of its own, for the scheduler's per-client queues, and a
+        # page of its own, whose previews supersede only each other (see previews.py).
+        n = next(self._ids)
+        self.session.headers["X-Forwarded-For"] = f"10.0.{n // 256}.{n % 256}"
+        self.session.headers["X-Preview-Session"] = f"bench-{n}"
+
+    def _post(self, path, url, **kwargs):
+        if self.spec["encoding"] == "json":
+            return self.session.post(self.base + path, json={"url": url}, **kwargs)
+        return self.session.post(self.base + path, data={"url": url}, **kwargs)
+
+    def _drain(self, response, started):
+        """(ttfb, bytes) after reading the whole body."""
+        ttfb = None
+        size = 0
+        for data in response.iter_content(64 * 1024):
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            size += len(data)
+        response.close()
+        return ttfb or time.perf_counter() - started, size
+
+    def preview(self, url):
+        started = time.perf_counter()
+        r = self._post("/preview", url, timeout=120)
+        ttfb, size = self._drain(r, started)
+        ok = r.ok and "error" not in r.text[:200]
+        return ok, ttfb, size
+
+    def download(self, url):
+        started = time.perf_counter()
+        flow = self.spec["flow"]
+        r = self._post(self.spec["download"], url, timeout=300, stream=True,
+                       allow_redirects=flow != "redirect")
+        if flow == "redirect" and r.is_redirect:
+            target = urljoin(self.base, r.headers["Location"])
+            r.close()
+            r = self.session.get(target, stream=True, timeout=300)
+        elif flow == "link" and r.ok:
+            target = urljoin(self.base, r.json().get("download_url", ""))
+            r = self.session.get(target, stream=True, timeout=300)
+        elif flow == "meta" and r.ok:
+            match = re.search(r"url=([^'\"]+)", r.text)
+            r = self.session.get(urljoin(self.base, match.group(1)), stream=True, timeout=300) if match else r
+        ttfb, size = self._drain(r, started)
+        return r.ok and size > 0, ttfb, size
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_load(base, spec, args, pid):
+    local = threading.local()
+    results = {"preview": [], "download": []}
+    lock = threading.Lock()
+    peak = [rss_kb(pid) or 0]
+    stop = threading.Event()
+
+    def sample_memory():
+        while not stop.wait(0.2):
+            peak[0] = max(peak[0], rss_kb(pid) or 0)
+
+    def one(i):
+        if not hasattr(local, "client"):
+            local.client = Client(base, spec)
+        video = random.randrange(args.videos)
+        url = f"https://www.tiktok.com/@bench/video/{ID_PREFIX}{video:011d}"
+        kind = "preview" if args.mix and i % 2 == 0 else "download"
+        started = time.perf_counter()
+        try:
+            ok, ttfb, size = getattr(local.client, kind)(url)
+        except requests.RequestException:
+            ok, ttfb, size = False, None, 0
+        elapsed = time.perf_counter() - started
+        with lock:
+            results[kind].append((ok, elapsed, ttfb, size))
+
+    threading.Thread(target=sample_memory, daemon=True).start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - started
+    stop.set()
+    return results, wall, peak[0]
+
+
+def report(variant, results, wall, rss_start, rss_peak, rss_end, upstream, as_json):
+    summary = {"variant": variant, "seconds": round(wall, 3), "upstream_calls": upstream.counts,
+               "rss_kb": {"start": rss_start, "peak": rss_peak, "end": rss_end}}
+    for kind, rows in results.items():
+        if not rows:
+            continue
+        ok = [r for r in rows if r[0]]
+        latency = [r[1] for r in ok]
+        ttfb = [r[2] for r in ok if r[2] is not None]
+        summary[kind] = {
+            "requests": len(rows),
+            "errors": len(rows) - len(ok),
+            "req_per_s": round(len(ok) / wall, 2),
+            "mb_per_s": round(sum(r[3] for r in ok) / wall / 1024 ** 2, 2),
+            "latency_ms": {f"p{p}": round(percentile(latency, p) * 1000, 1) for p in (50, 95, 99)},
+            "ttfb_ms": {f"p{p}": round(percentile(ttfb, p) * 1000, 1) for p in (50, 95, 99)},
+        }
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{variant}: {wall:.1f}s wall, upstream calls {upstream.counts}")
+    print(f"  server RSS  start {rss_start} KiB  peak {rss_peak} KiB  end {rss_end} KiB")
+    for kind in ("preview", "download"):
+        s = summary.get(kind)
+        if not s:
+            continue
+        lat, ttfb = s["latency_ms"], s["ttfb_ms"]
+        print(f"  {kind:<9} {s['requests']:5d} req  {s['errors']:4d} err  {s['req_per_s']:8.1f} req/s  "
+              f"{s['mb_per_s']:7.1f} MB/s")
+        print(f"            latency p50 {lat['p50']:8.1f}  p95 {lat['p95']:8.1f}  p99 {lat['p99']:8.1f} ms")
+        print(f"            ttfb    p50 {ttfb['p50']:8.1f}  p95 {ttfb['p95']:8.1f}  p99 {ttfb['p99']:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a tkdl variant against local fake upstreams.")
+    parser.add_argument("variant", choices=sorted(VARIANTS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="total requests")
+    parser.add_argument("--videos", type=int, default=50, help="distinct videos requested (cache hit rate)")
+    parser.add_argument("--no-preview", dest="mix", action="store_false", help="only run downloads")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to each upstream call")
+    parser.add_argument("--bandwidth", type=parse_size, default=parse_size("20MB"),
+                        help="CDN bytes/s per connection (0 = unlimited)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument("--size", type=parse_size, default=parse_size("2MB"), help="synthetic video size")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the app, e.g. TKDL_STREAM=0")
+    parser.add_argument("--workers", type=int, default=1, help="run the variant under serve.py with N processes")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    upstream = Upstream(args.latency, args.bandwidth, args.fail_rate, args.size)
+    server = start_upstream(upstream)
+    port = free_port()
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    cleanup_files()
+    proc = start_app(args.variant, port, upstream, extra_env, args.workers)
+    try:
+        rss_start = rss_kb(proc.pid)
+        results, wall, rss_peak = run_load(f"http://127.0.0.1:{port}", VARIANTS[args.variant], args, proc.pid)
+        rss_end = rss_kb(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        server.shutdown()
+        cleanup_files()
+    report(args.variant, results, wall, rss_start, rss_peak, rss_end, upstream, args.json)
+
+
+if __name__ == "__main__":
+    main()
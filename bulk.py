@@ -0,0 +1,178 @@
+"""
+Bulk-download every video of TikTok profiles and hashtags.
+
+    python bulk.py @someuser #sometag --out bulk --concurrency 4 --rate 1
+
+Video IDs already fetched are remembered in <out>/index.json, so a re-run
+only downloads posts that are new since the last sync. Listing uses
+TikTokApi, which drives a headless browser (`python -m playwright install
+chromium`); set MS_TOKEN to a tiktok.com ms_token cookie for reliable
+results. Downloads go through the same provider chain as the web app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from providers import fetch_video
+from videocache import VideoCache, cache_name
+
+PROFILE_RE = re.compile(r"(?:tiktok\.com/)?@([A-Za-z0-9._]+)")
+HASHTAG_RE = re.compile(r"(?:tiktok\.com/tag/|#|tag:)([^/?#\s]+)")
+
+
+def parse_source(text):
+    """'@user', a profile URL, '#tag' or 'tag:name' -> ("user"|"tag", name)."""
+    match = PROFILE_RE.search(text)
+    if match:
+        return "user", match.group(1)
+    match = HASHTAG_RE.search(text)
+    if match:
+        return "tag", match.group(1)
+    raise ValueError(f"not a @profile or #hashtag: {text}")
+
+
+def source_key(kind, name):
+    return f"@{name}" if kind == "user" else f"#{name}"
+
+
+class SyncIndex:
+    """video ID -> where it came from and when it was fetched, persisted as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {"videos": {}, "sources": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def __contains__(self, video_id):
+        return video_id in self.data["videos"]
+
+    def add(self, video_id, source, filename):
+        with self._lock:
+            self.data["videos"][video_id] = {
+                "source": source,
+                "file": filename,
+                "fetched": int(time.time()),
+            }
+            self._save()
+
+    def synced(self, source, count):
+        with self._lock:
+            self.data["sources"][source] = {"synced": int(time.time()), "new": count}
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class Throttle:
+    """Space calls at least 1/rate seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+async def list_new_videos(sources, index, stop_after_known, limit, ms_token):
+    """
+    [(source, video_id, url)] not yet in `index`. Listings are newest first,
+    so a source stops after `stop_after_known` consecutive known videos
+    (pinned posts make a single hit unreliable); 0 lists everything.
+    """
+    from TikTokApi import TikTokApi
+
+    found = []
+    async with TikTokApi() as api:
+        await api.create_sessions(
+            ms_tokens=[ms_token] if ms_token else None,
+            num_sessions=1,
+            sleep_after=3,
+            browser=os.environ.get("TIKTOK_BROWSER", "chromium"),
+        )
+        for kind, name in sources:
+            key = source_key(kind, name)
+            listing = api.user(username=name) if kind == "user" else api.hashtag(name=name)
+            known_run = 0
+            new = 0
+            async for video in listing.videos(count=limit or 10 ** 6):
+                video_id = str(video.id)
+                if video_id in index:
+                    known_run += 1
+                    if stop_after_known and known_run >= stop_after_known:
+                        break
+                    continue
+                known_run = 0
+                author = getattr(video.author, "username", None) or name
+                found.append((key, video_id, f"https://www.tiktok.com/@{author}/video/{video_id}"))
+                new += 1
+            print(f"[Bulk] {key}: {new} new videos")
+    return found
+
+
+def download_all(videos, out, index, concurrency, rate):
+    store = VideoCache(out, max_bytes=float("inf"))
+    throttle = Throttle(rate)
+
+    def fetch(url):
+        throttle.wait()
+        return store.fetch(cache_name(url), lambda filepath: fetch_video(url, filepath))
+
+    ok = failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(fetch, url): (source, video_id) for source, video_id, url in videos}
+        for future in as_completed(futures):
+            source, video_id = futures[future]
+            try:
+                index.add(video_id, source, future.result())
+                ok += 1
+            except Exception as e:
+                failed += 1
+                print(f"[Bulk] {video_id} failed: {e}")
+    return ok, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download all videos of TikTok profiles / hashtags.")
+    parser.add_argument("sources", nargs="+", help="@username, profile URL, #hashtag or tag:name")
+    parser.add_argument("--out", default="bulk", help="download folder (holds index.json)")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel downloads")
+    parser.add_argument("--rate", type=float, default=1.0, help="max downloads started per second (0 = unlimited)")
+    parser.add_argument("--limit", type=int, default=0, help="max videos listed per source (0 = all)")
+    parser.add_argument("--stop-after-known", type=int, default=20,
+                        help="stop listing a source after this many already-fetched videos in a row (0 = never)")
+    parser.add_argument("--ms-token", default=os.environ.get("MS_TOKEN"), help="tiktok.com ms_token cookie")
+    args = parser.parse_args()
+
+    sources = [parse_source(s) for s in args.sources]
+    os.makedirs(args.out, exist_ok=True)
+    index = SyncIndex(os.path.join(args.out, "index.json"))
+
+    videos = asyncio.run(list_new_videos(sources, index, args.stop_after_known, args.limit, args.ms_token))
+    ok, failed = download_all(videos, args.out, index, args.concurrency, args.rate)
+    for kind, name in sources:
+        key = source_key(kind, name)
+        index.synced(key, sum(1 for s, _, _ in videos if s == key))
+    print(f"[Bulk] done: {ok} downloaded, {failed} failed, {len(index.data['videos'])} in index")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+One canonical form per TikTok video, so every cache and dedup layer
+(metadata, video files, covers, in-flight resolutions) keys equivalent
+URLs the same way.
+
+    https://www.tiktok.com/@user/video/ID?is_from_webapp=1  -> .../@user/video/ID
+    https://m.tiktok.com/v/ID.html                          -> .../@_/video/ID
+    https://vm.tiktok.com/ZMabc123/                         -> expanded once, then
+                                                               remembered on disk
+
+Short links carry no video ID, so the first sighting follows the redirect
+(HEAD) and the answer goes into a persistent short-link index.
+"""
+import json
+import os
+import re
+import threading
+from urllib.parse import urlparse
+
+from httppool import http_session
+from metacache import video_id_from_url
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SHORTLINK_INDEX = os.environ.get("TKDL_SHORTLINK_INDEX", os.path.join(BASE_DIR, "shortlinks.jsonl"))
+SHORT_HOSTS = ("vm.tiktok.com", "vt.tiktok.com")
+CANONICAL_RE = re.compile(r"(https?://(?:www\.)?tiktok\.com/@[A-Za-z0-9._]+/(?:video|photo)/\d+)")
+SHORT_TIMEOUT = 10
+
+
+def video_page_url(video_id):
+    """A page URL for `video_id`; TikTok redirects any @name to the right one."""
+    return f"https://www.tiktok.com/@_/video/{video_id}"
+
+
+def is_tiktok_host(host):
+    return host == "tiktok.com" or host.endswith(".tiktok.com")
+
+
+def is_short_link(url):
+    """vm./vt.tiktok.com/<code> or tiktok.com/t/<code>: no video ID until expanded."""
+    parsed = urlparse(url if "://" in url else "https://" + url)
+    host = parsed.hostname or ""
+    return host in SHORT_HOSTS or (is_tiktok_host(host) and parsed.path.startswith("/t/"))
+
+
+def canonical_form(url):
+    """Canonical URL if `url` names a video directly, else None."""
+    match = CANONICAL_RE.search(url)
+    if match:
+        return match.group(1).replace("http://", "https://").replace("://tiktok.com", "://www.tiktok.com")
+    video_id = video_id_from_url(url)
+    return video_page_url(video_id) if video_id else None
+
+
+class ShortLinkIndex:
+    """
+    short link -> canonical URL, appended to a JSON-lines file as they are
+    learned and read back at start-up. Concurrent lookups of the same
+    unknown link share one redirect request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._links = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.expanded = 0
+        self.failures = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self._links[entry["short"]] = entry["url"]
+                except (ValueError, KeyError):
+                    continue  # torn last line after a crash
+
+    def _add(self, short, url):
+        with self._lock:
+            self._links[short] = url
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"short": short, "url": url}) + "\n")
+
+    def known(self, short):
+        """Canonical URL behind `short` if it has been expanded before; never blocks."""
+        with self._lock:
+            return self._links.get(short)
+
+    def resolve(self, short):
+        """Canonical URL behind `short`, or None if it doesn't lead to a video."""
+        with self._lock:
+            url = self._links.get(short)
+            if url:
+                self.hits += 1
+                return url
+            flight = self._inflight.get(short)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[short] = threading.Event()
+        if not leader:
+            flight.wait()
+            with self._lock:
+                return self._links.get(short)
+        try:
+            url = self._expand(short)
+            if url:
+                self._add(short, url)
+            return url
+        finally:
+            with self._lock:
+                self._inflight.pop(short, None)
+            flight.set()
+
+    def _expand(self, short):
+        try:
+            r = http_session.head(short, allow_redirects=True, timeout=SHORT_TIMEOUT)
+            if r.status_code == 405 or not canonical_form(r.url):
+                # Some edges refuse HEAD; the redirect chain is the same for GET.
+                r = http_session.get(short, allow_redirects=True, timeout=SHORT_TIMEOUT, stream=True)
+                r.close()
+            url = canonical_form(r.url)
+        except Exception as e:
+            print(f"[Canonical] could not expand {short}: {e}")
+            url = None
+        if url:
+            self.expanded += 1
+        else:
+            self.failures += 1
+        return url
+
+    def stats(self):
+        with self._lock:
+            return {
+                "links": len(self._links),
+                "hits": self.hits,
+                "expanded": self.expanded,
+                "failures": self.failures,
+                "inflight": len(self._inflight),
+            }
+
+
+short_links = ShortLinkIndex(SHORTLINK_INDEX)
+
+
+def sanitize_url(url, expand=True):
+    """
+    Canonical https://www.tiktok.com/@user/video/ID form of a TikTok URL,
+    expanding short links (see above). Other TikTok URLs lose their query
+    string; non-TikTok input gives None. With `expand=False` a short link
+    that isn't in the index yet comes back as a short link, without the
+    network round trip; sanitizing it again later expands it.
+    """
+    if not url:
+        return None
+    url = url.strip()
+    if not url.startswith("http"):
+        url = "https://" + url
+    host = urlparse(url).hostname or ""
+    if not is_tiktok_host(host):
+        return None
+    canonical = canonical_form(url)
+    if canonical:
+        return canonical
+    url = url.split("?")[0]
+    if is_short_link(url):
+        short = "https://" + host + urlparse(url).path.rstrip("/") + "/"
+        if not expand:
+            return short_links.known(short) or short
+        # Unexpandable: hand the short link on, providers may still cope.
+        return short_links.resolve(short) or short
+    return url
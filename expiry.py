@@ -0,0 +1,255 @@
+import heapq
+import os
+import shutil
+import threading
+import time
+
+from metrics import CLEANUP_REMOVED, CLEANUP_RUNS, CLEANUP_SECONDS, GaugeFunc
+from shared import STATE_DB, OwnerLock, connect, pid_alive, transaction
+
+
+class ExpiryIndex:
+    """
+    Deletes files and temp dirs when they expire.
+
+    Expiry times sit in a heap, so one thread sleeps until exactly the next
+    one is due instead of rescanning folders or keeping a thread per file.
+    A path that is leased (e.g. while a response is still sending it) is
+    kept past its expiry and removed as soon as the last lease is released.
+    """
+
+    def __init__(self):
+        self._heap = []  # (expires_at, path); may hold stale entries
+        self._due = {}  # path -> current expires_at
+        self._leases = {}  # path -> count
+        self._cond = threading.Condition()
+        self._thread = None
+        self.removed = 0
+        self.deferred = 0
+
+    def schedule(self, path, delay):
+        """Delete `path` in `delay` seconds (rescheduling it if already known)."""
+        expires_at = time.time() + delay
+        with self._cond:
+            self._due[path] = expires_at
+            heapq.heappush(self._heap, (expires_at, path))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="expiry", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def cancel(self, path):
+        with self._cond:
+            self._due.pop(path, None)
+
+    def adopt(self, folder, ttl, dirs=False):
+        """
+        Schedule what a previous run left in `folder`, `ttl` seconds after
+        each entry's mtime. One listing at start-up; nothing is rescanned.
+        """
+        now = time.time()
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.isdir(path) if dirs else os.path.isfile(path):
+                self.schedule(path, max(0.0, os.path.getmtime(path) + ttl - now))
+
+    def acquire(self, path):
+        with self._cond:
+            self._leases[path] = self._leases.get(path, 0) + 1
+
+    def release(self, path):
+        with self._cond:
+            count = self._leases.get(path, 0) - 1
+            if count > 0:
+                self._leases[path] = count
+                return
+            self._leases.pop(path, None)
+            expires_at = self._due.get(path)
+            if expires_at is not None and expires_at <= time.time():
+                # Expired while in use: delete it now.
+                heapq.heappush(self._heap, (expires_at, path))
+                self._cond.notify()
+
+    def release_with(self, response, path):
+        """Release a lease on `path` once the Flask `response` has been sent."""
+        # send_file responses are passed straight through to the server, which
+        # skips call_on_close; closing the body is what always happens. The
+        # body object itself is kept so the server still recognises its own
+        # file_wrapper and can os.sendfile() it.
+        body = response.response
+        close = getattr(body, "close", None)
+
+        def close_and_release():
+            try:
+                if close is not None:
+                    close()
+            finally:
+                self.release(path)
+
+        try:
+            body.close = close_and_release
+        except AttributeError:  # e.g. a list body
+            from werkzeug.wsgi import ClosingIterator
+            response.response = ClosingIterator(body, lambda: self.release(path))
+        return response
+
+    def remove_unleased(self, paths):
+        """
+        Delete those of `paths` that aren't leased right now and return
+        them; leased ones are left for the caller to try again later. For
+        files someone else owns, like the video cache's.
+        """
+        with self._cond:
+            removed = [path for path in paths if not self._leases.get(path)]
+            for path in removed:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return removed
+
+    def _take_due(self):
+        """Block until something is due; return the paths to delete (lock held by caller)."""
+        while True:
+            now = time.time()
+            ready = []
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, path = heapq.heappop(self._heap)
+                if self._due.get(path) != expires_at:
+                    continue  # rescheduled or cancelled since
+                if self._leases.get(path):
+                    self.deferred += 1  # release() puts it back
+                    continue
+                del self._due[path]
+                ready.append(path)
+            if ready:
+                return ready
+            self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                paths = self._take_due()
+            with CLEANUP_SECONDS.time():
+                for path in paths:
+                    self._remove(path)
+            CLEANUP_RUNS.inc()
+
+    def _remove(self, path):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                CLEANUP_REMOVED.inc(kind="dir")
+            elif os.path.exists(path):
+                os.remove(path)
+                CLEANUP_REMOVED.inc(kind="file")
+            else:
+                return
+            self.removed += 1
+        except OSError as e:
+            print(f"[CLEANUP ERROR] {path}: {e}")
+
+    def stats(self):
+        with self._cond:
+            return {
+                "scheduled": len(self._due),
+                "leased": len(self._leases),
+                "removed": self.removed,
+                "deferred": self.deferred,
+            }
+
+
+class SharedExpiryIndex(ExpiryIndex):
+    """
+    The expiry index in a SQLite file (see shared.py) for several worker
+    processes: any of them schedules and leases paths, exactly one - the
+    holder of the owner lock - deletes them. The others keep trying the
+    lock, so a new owner takes over if that process dies.
+    """
+
+    POLL_SECONDS = 1.0
+    ELECTION_SECONDS = 5.0
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self.owner = OwnerLock(db_path, "expiry")
+        db = connect(db_path)
+        db.execute("CREATE TABLE IF NOT EXISTS expiry (path TEXT PRIMARY KEY, expires_at REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS expiry_due ON expiry (expires_at)")
+        db.execute("CREATE TABLE IF NOT EXISTS leases (path TEXT, pid INTEGER, count INTEGER,"
+                   " PRIMARY KEY (path, pid))")
+        self._thread = threading.Thread(target=self._run, name="expiry", daemon=True)
+        self._thread.start()
+
+    def schedule(self, path, delay):
+        connect(self.db_path).execute("INSERT OR REPLACE INTO expiry VALUES (?, ?)", (path, time.time() + delay))
+
+    def cancel(self, path):
+        connect(self.db_path).execute("DELETE FROM expiry WHERE path = ?", (path,))
+
+    def acquire(self, path):
+        connect(self.db_path).execute(
+            "INSERT INTO leases VALUES (?, ?, 1) ON CONFLICT (path, pid) DO UPDATE SET count = count + 1",
+            (path, os.getpid()))
+
+    def release(self, path):
+        # A path that expired while leased goes on the owner's next pass.
+        with transaction(self.db_path) as db:
+            db.execute("UPDATE leases SET count = count - 1 WHERE path = ? AND pid = ?", (path, os.getpid()))
+            db.execute("DELETE FROM leases WHERE count <= 0")
+
+    def remove_unleased(self, paths):
+        # Inside the write transaction, so no lease can be taken in between.
+        with transaction(self.db_path) as db:
+            removed = [path for path in paths
+                       if not db.execute("SELECT 1 FROM leases WHERE path = ?", (path,)).fetchone()]
+            for path in removed:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return removed
+
+    def _take_due(self):
+        with transaction(self.db_path) as db:
+            for (pid,) in db.execute("SELECT DISTINCT pid FROM leases").fetchall():
+                if not pid_alive(pid):
+                    db.execute("DELETE FROM leases WHERE pid = ?", (pid,))  # died mid-send
+            now = time.time()
+            due = [path for (path,) in db.execute(
+                "SELECT path FROM expiry WHERE expires_at <= ?"
+                " AND path NOT IN (SELECT path FROM leases)", (now,))]
+            db.executemany("DELETE FROM expiry WHERE path = ?", [(path,) for path in due])
+            self.deferred = db.execute(
+                "SELECT COUNT(*) FROM expiry WHERE expires_at <= ?", (now,)).fetchone()[0]
+        return due
+
+    def _run(self):
+        while not self.owner.try_acquire():
+            time.sleep(self.ELECTION_SECONDS)
+        print(f"[CLEANUP] pid {os.getpid()} owns file expiry")
+        while True:
+            paths = self._take_due()
+            if paths:
+                with CLEANUP_SECONDS.time():
+                    for path in paths:
+                        self._remove(path)
+                CLEANUP_RUNS.inc()
+            time.sleep(self.POLL_SECONDS)
+
+    def stats(self):
+        db = connect(self.db_path)
+        return {
+            "scheduled": db.execute("SELECT COUNT(*) FROM expiry").fetchone()[0],
+            "leased": db.execute("SELECT COUNT(DISTINCT path) FROM leases").fetchone()[0],
+            "removed": self.removed,
+            "deferred": self.deferred,
+            "owner": int(self.owner.held),
+        }
+
+
+file_expiry = SharedExpiryIndex(STATE_DB) if STATE_DB else ExpiryIndex()
+
+GaugeFunc("tkdl_expiry", "Expiry index: scheduled and leased paths.", ("field",),
+          lambda: [((k,), v) for k, v in file_expiry.stats().items()])
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from collections import deque
+
+# Outcomes older than this don't count towards a provider's health.
+WINDOW_SECONDS = 120
+# Open the circuit after this many failures in a row...
+FAILURE_THRESHOLD = int(os.environ.get("TKDL_BREAKER_FAILURES", "5"))
+# ...or when at least MIN_SAMPLES recent calls have this failure rate.
+FAILURE_RATE = 0.8
+MIN_SAMPLES = 10
+# How long an open circuit skips the provider before letting a probe through.
+# Doubles after every failed probe, up to MAX_OPEN_SECONDS.
+OPEN_SECONDS = float(os.environ.get("TKDL_BREAKER_COOLDOWN", "30"))
+MAX_OPEN_SECONDS = 600
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+# What allow() returns for the one call let through while half-open.
+PROBE = "probe"
+
+
+class NotFound(Exception):
+    """A provider's well-formed "no such video" answer: the provider itself works."""
+
+
+def is_failure(error):
+    """
+    Whether `error` from a provider call counts against its health:
+    transport errors, timeouts and 5xx/429 responses do; NotFound and
+    other 4xx answers (a bad or deleted video) don't.
+    """
+    if isinstance(error, NotFound):
+        return False
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is None or status >= 500 or status == 429
+
+
+class ProviderHealth:
+    """Sliding-window success/latency record and circuit breaker for one provider."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.window = deque()  # (timestamp, ok, seconds)
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.cooldown = OPEN_SECONDS
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self.window and now - self.window[0][0] > WINDOW_SECONDS:
+            self.window.popleft()
+
+    def allow(self):
+        """
+        Truthy if a call may go to this provider now. While half-open only
+        one probe call is let through at a time and PROBE is returned for
+        it; the caller passes `probe=` back to record() or release(), so a
+        late answer from an older call isn't taken for the probe's.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+                print(f"[Health] {self.name} half-open, probing")
+            if self.probing:
+                return False
+            self.probing = True
+            return PROBE
+
+    def record(self, ok, seconds, probe=False):
+        now = time.monotonic()
+        with self._lock:
+            self.window.append((now, ok, seconds))
+            self._trim(now)
+            if probe:
+                self.probing = False
+            if ok:
+                self.consecutive_failures = 0
+                if self.state != CLOSED:
+                    print(f"[Health] {self.name} recovered, circuit closed")
+                self.state = CLOSED
+                self.cooldown = OPEN_SECONDS
+                return
+            self.consecutive_failures += 1
+            if probe and self.state == HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, MAX_OPEN_SECONDS)
+                self._open(now)
+            elif self.state == CLOSED and self._unhealthy():
+                self._open(now)
+
+    def release(self, probe=False):
+        """The call was abandoned (e.g. cancelled); it says nothing about health."""
+        if probe:
+            with self._lock:
+                self.probing = False
+
+    def _unhealthy(self):
+        if self.consecutive_failures >= FAILURE_THRESHOLD:
+            return True
+        if len(self.window) < MIN_SAMPLES:
+            return False
+        failures = sum(1 for _, ok, _ in self.window if not ok)
+        return failures / len(self.window) >= FAILURE_RATE
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        print(f"[Health] {self.name} failing, circuit open for {self.cooldown:.0f}s")
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            samples = list(self.window)
+            state = self.state
+        latencies = sorted(s for _, ok, s in samples if ok)
+        successes = len(latencies)
+
+        def pct(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+        return {
+            "state": state,
+            "samples": len(samples),
+            "success_rate": round(successes / len(samples), 3) if samples else None,
+            "p50": pct(0.5),
+            "p95": pct(0.95),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def provider_health(name):
+    """The shared ProviderHealth for `name` (created on first use)."""
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = ProviderHealth(name)
+        return _registry[name]
+
+
+def health_stats():
+    with _registry_lock:
+        providers = dict(_registry)
+    return {name: h.stats() for name, h in providers.items()}
@@ -0,0 +1,104 @@
+import os
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT = float(os.environ.get("TKDL_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("TKDL_READ_TIMEOUT", "30"))
+
+# Keep-alive connections kept per upstream host. The API hosts get a few;
+# CDN hosts (which vary per video) share the default adapter.
+POOL_SIZES = {
+    "www.tikwm.com": 16,
+    "api.snaptik.app": 8,
+    "ssstik.io": 8,
+}
+DEFAULT_POOL_SIZE = int(os.environ.get("TKDL_POOL_SIZE", "32"))
+# Number of distinct CDN hosts we keep pools for.
+DEFAULT_POOL_HOSTS = 20
+
+# Only idempotent methods are retried; the provider API POSTs are left to
+# the resolver chain, which falls back to another provider instead.
+RETRY = Retry(
+    total=2,
+    connect=2,
+    read=1,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+    raise_on_status=False,
+)
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session with keep-alive pools sized per host, retries on
+    idempotent calls and (connect, read) timeouts applied by default.
+    A bare number passed as `timeout` is taken as the read timeout.
+    """
+
+    def __init__(self):
+        super().__init__()
+        default = HTTPAdapter(
+            pool_connections=DEFAULT_POOL_HOSTS,
+            pool_maxsize=DEFAULT_POOL_SIZE,
+            max_retries=RETRY,
+        )
+        self.mount("https://", default)
+        self.mount("http://", default)
+        for host, size in POOL_SIZES.items():
+            self.mount(
+                f"https://{host}/",
+                HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=RETRY),
+            )
+        self._lock = threading.Lock()
+        self.requests_by_host = {}
+        self.errors_by_host = {}
+
+    def request(self, method, url, **kwargs):
+        timeout = kwargs.get("timeout")
+        if timeout is None:
+            kwargs["timeout"] = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        elif isinstance(timeout, (int, float)):
+            kwargs["timeout"] = (min(CONNECT_TIMEOUT, timeout), timeout)
+        host = urlparse(url).hostname or ""
+        with self._lock:
+            self.requests_by_host[host] = self.requests_by_host.get(host, 0) + 1
+        try:
+            return super().request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors_by_host[host] = self.errors_by_host.get(host, 0) + 1
+            raise
+
+    def pool_stats(self):
+        """Per-host connection pool utilisation."""
+        pools = {}
+        for adapter in set(self.adapters.values()):
+            manager = adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                pools[pool.host] = {
+                    "maxsize": pool.pool.maxsize,
+                    "opened": pool.num_connections,
+                    "idle": idle,
+                    "requests": pool.num_requests,
+                }
+        with self._lock:
+            requests_by_host = dict(self.requests_by_host)
+            errors_by_host = dict(self.errors_by_host)
+        return {
+            "pools": pools,
+            "requests": requests_by_host,
+            "errors": errors_by_host,
+        }
+
+
+# Shared by every upstream call in the process.
+http_session = PooledSession()
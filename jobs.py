@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
+
+from scheduler import client_id
+from shared import STATE_DB, connect, transaction
+from tracing import in_context
+
+# Finished jobs are forgotten after this long (the file itself lives on in
+# the video cache until evicted).
+JOB_TTL = 3600
+MAX_JOBS = 5000
+# SSE comment sent when nothing changed, so proxies keep the stream open.
+KEEPALIVE_SECONDS = 15
+# Threads running job bodies. A job mostly waits: for its turn on the
+# download scheduler, or for a download of the same video already running.
+JOB_THREADS = int(os.environ.get("TKDL_JOB_THREADS", "32"))
+# Don't wake watchers for every chunk.
+PROGRESS_STEP = 256 * 1024
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "error"
+
+
+class Job:
+    def __init__(self, url):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.status = QUEUED
+        self.bytes = 0
+        self.total = 0
+        self.filename = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+
+    def to_dict(self):
+        percent = None
+        if self.status == DONE:
+            percent = 100.0
+        elif self.total:
+            percent = round(100.0 * self.bytes / self.total, 1)
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "bytes": self.bytes,
+            "total": self.total or None,
+            "percent": percent,
+        }
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+class JobTable:
+    """In-memory job records; watchers block on changes instead of polling."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._cond = threading.Condition()
+
+    def create(self, url):
+        job = Job(url)
+        with self._cond:
+            self._expire()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def update(self, job, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            if fields.get("status") in (DONE, FAILED):
+                job.finished = time.time()
+            job.version += 1
+            self._cond.notify_all()
+
+    def progress(self, job, done, total):
+        # Called for every chunk; several providers may race, so keep the max.
+        if done - job.bytes >= PROGRESS_STEP or (total and done >= total) or total != job.total:
+            self.update(job, bytes=max(done, job.bytes), total=total or job.total)
+
+    def wait(self, job, version, timeout):
+        """Block until `job` changes past `version` or `timeout` passes."""
+        with self._cond:
+            self._cond.wait_for(lambda: job.version != version, timeout=timeout)
+            return job.version, job.to_dict()
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished > JOB_TTL:
+                del self._jobs[job_id]
+        while len(self._jobs) >= MAX_JOBS:
+            del self._jobs[next(iter(self._jobs))]
+
+    def stats(self):
+        with self._cond:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+
+class SharedJobTable(JobTable):
+    """
+    The job table in a SQLite file (see shared.py), so a job started by one
+    worker process can be polled through any other. Watchers poll the row.
+    """
+
+    POLL_SECONDS = 0.25
+    FIELDS = ("status", "bytes", "total", "filename", "error", "created", "finished", "version")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        connect(db_path).execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, url TEXT, status TEXT, bytes INTEGER,"
+            " total INTEGER, filename TEXT, error TEXT, created REAL, finished REAL, version INTEGER)")
+
+    def _row(self, job):
+        return tuple(getattr(job, name) for name in self.FIELDS)
+
+    def _refresh(self, job):
+        row = connect(self.db_path).execute(
+            f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE id = ?", (job.id,)).fetchone()
+        if row:
+            for name, value in zip(self.FIELDS, row):
+                setattr(job, name, value)
+        return job
+
+    def create(self, url):
+        job = Job(url)
+        with transaction(self.db_path) as db:
+            self._expire(db)
+            db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (job.id, job.url) + self._row(job))
+        return job
+
+    def get(self, job_id):
+        row = connect(self.db_path).execute("SELECT url FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = Job(row[0])
+        job.id = job_id
+        return self._refresh(job)
+
+    def update(self, job, **fields):
+        for name, value in fields.items():
+            setattr(job, name, value)
+        if fields.get("status") in (DONE, FAILED):
+            job.finished = time.time()
+        with transaction(self.db_path) as db:
+            job.version = db.execute("SELECT version FROM jobs WHERE id = ?", (job.id,)).fetchone()[0] + 1
+            db.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in self.FIELDS)} WHERE id = ?",
+                       self._row(job) + (job.id,))
+
+    def wait(self, job, version, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self._refresh(job)
+            if job.version != version or time.monotonic() >= deadline:
+                return job.version, job.to_dict()
+            time.sleep(self.POLL_SECONDS)
+
+    def _expire(self, db):
+        db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (time.time() - JOB_TTL,))
+        db.execute("DELETE FROM jobs WHERE id IN (SELECT id FROM jobs ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                   (MAX_JOBS - 1,))
+
+    def stats(self):
+        return dict(connect(self.db_path).execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+
+job_table = SharedJobTable(STATE_DB) if STATE_DB else JobTable()
+
+
+def jobs_blueprint(run, sanitize=lambda url, expand=True: url, file_endpoint="serve_file"):
+    """
+    /jobs API around `run(url, progress, client)`, which downloads the video
+    and returns the filename to hand to `file_endpoint`. `progress(done, total)`
+    reports bytes as they arrive. Jobs run on their own threads, not on the
+    download scheduler: `run` takes a scheduler slot for `client` only for
+    the download itself, as the synchronous routes do, so a job waiting on
+    a download that is queued behind it can't deadlock the workers.
+    POST /jobs only checks the URL (`sanitize(url, expand=False)`); short
+    links are expanded by the job.
+
+        POST /jobs                 {"url": ...} -> 202 {"job_id", ...}
+        GET  /jobs/<id>            status, percent and download_url when done
+        GET  /jobs/<id>/events     the same as Server-Sent Events
+    """
+    bp = Blueprint("jobs", __name__)
+    executor = ThreadPoolExecutor(max_workers=JOB_THREADS, thread_name_prefix="job")
+
+    def describe(data, job):
+        if job.status == DONE:
+            data["download_url"] = url_for(file_endpoint, filename=job.filename)
+        return data
+
+    def execute(job, client):
+        job_table.update(job, status=RUNNING)
+        try:
+            url = sanitize(job.url)
+            filename = run(url, lambda done, total: job_table.progress(job, done, total), client)
+            job_table.update(job, status=DONE, filename=filename)
+        except Exception as e:
+            job_table.update(job, status=FAILED, error=str(e))
+
+    @bp.route("/jobs", methods=["POST"])
+    def submit_job():
+        payload = request.get_json(silent=True) or {}
+        url = sanitize(request.form.get("url") or payload.get("url"), expand=False)
+        if not url:
+            return jsonify({"error": "Invalid TikTok URL"}), 400
+        job = job_table.create(url)
+        executor.submit(in_context(execute), job, client_id(request))
+        data = job.to_dict()
+        data["status_url"] = url_for("jobs.job_status", job_id=job.id)
+        data["events_url"] = url_for("jobs.job_events", job_id=job.id)
+        return jsonify(data), 202
+
+    @bp.route("/jobs/<job_id>")
+    def job_status(job_id):
+        job = job_table.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(describe(job.to_dict(), job))
+
+    @bp.route("/jobs/<job_id>/events")
+    def job_events(job_id):
+        job = job_table.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+
+        @stream_with_context
+        def events():
+            version = -1
+            while True:
+                new_version, data = job_table.wait(job, version, KEEPALIVE_SECONDS)
+                if new_version == version:
+                    yield ": keep-alive\n\n"
+                    continue
+                version = new_version
+                describe(data, job)
+                yield f"event: {data['status']}\ndata: {json.dumps(data)}\n\n"
+                if data["status"] in (DONE, FAILED):
+                    return
+
+        return Response(events(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return bp
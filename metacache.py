@@ -0,0 +1,131 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+# Signed TikTok CDN links usually stay valid for a few hours; we never keep
+# metadata longer than this even if the link claims a later expiry.
+DEFAULT_TTL = 600
+# Drop entries a bit before the CDN link actually expires so a download that
+# starts right at the edge doesn't get a 403 halfway through.
+EXPIRY_MARGIN = 30
+
+VIDEO_ID_RE = re.compile(r"/(?:video|photo|v)/(\d{8,})")
+EXPIRY_PARAMS = ("x-expires", "expire", "expires")
+
+
+def video_id_from_url(url: str):
+    """Return the numeric TikTok video ID in `url`, or None."""
+    if not url:
+        return None
+    match = VIDEO_ID_RE.search(url)
+    if match:
+        return match.group(1)
+    query = parse_qs(urlparse(url).query)
+    for name in ("item_id", "share_item_id"):
+        if query.get(name, [""])[0].isdigit():
+            return query[name][0]
+    return None
+
+
+def cache_key(url: str) -> str:
+    """Key for `url`: the video ID when we can find one, else the URL itself."""
+    return video_id_from_url(url) or (url or "").strip()
+
+
+def signed_url_expiry(value):
+    """Earliest `x-expires`-style timestamp found in the URLs inside `value`."""
+    if isinstance(value, dict):
+        found = [signed_url_expiry(v) for v in value.values()]
+        found = [f for f in found if f]
+        return min(found) if found else None
+    if not isinstance(value, str) or not value.startswith("http"):
+        return None
+    query = parse_qs(urlparse(value).query)
+    for name in EXPIRY_PARAMS:
+        stamp = query.get(name, [""])[0]
+        if stamp.isdigit():
+            return int(stamp)
+    return None
+
+
+class MetadataCache:
+    """Thread-safe LRU cache of resolved video metadata with per-entry expiry."""
+
+    def __init__(self, maxsize=512, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl
+        signed = signed_url_expiry(value)
+        if signed:
+            expires_at = min(expires_at, signed - EXPIRY_MARGIN)
+        if expires_at <= now:
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def lookup(self, url, resolve, namespace=""):
+        """
+        Return cached metadata for `url`, calling `resolve(url)` on a miss.
+        Falsy results and dicts with success=False are not cached.
+        """
+        key = f"{namespace}:{cache_key(url)}"
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = resolve(url)
+        if value and not (isinstance(value, dict) and value.get("success") is False):
+            self.set(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+metadata_cache = MetadataCache()
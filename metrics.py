@@ -0,0 +1,222 @@
+"""
+Minimal Prometheus-style metrics, rendered in the text exposition format
+by /metrics. Counters and histograms are updated where things happen;
+gauges that mirror existing stats() dicts are read at scrape time.
+"""
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add `metric`; registering a name again replaces the old one."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"[Metrics error] {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _items(self):
+        with self._lock:
+            return sorted((k, list(v) if isinstance(v, list) else v) for k, v in self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, value in self._items():
+            lines.extend(self._lines(key, value))
+        return lines
+
+    def _lines(self, key, value):
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class GaugeFunc(_Metric):
+    """Gauge read at scrape time: `fn()` returns [(label values tuple, value)]."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels, fn):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def _items(self):
+        return sorted((tuple(str(v) for v in key), value) for key, value in self.fn())
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts, then sum and count
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        """Context manager observing the seconds spent inside it."""
+        return _Timer(self, labels)
+
+    def _lines(self, key, state):
+        lines = []
+        for bound, count in zip(self.buckets, state):
+            le = [("le", _number(float(bound)))]
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {count}")
+        lines.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', '+Inf')])} {state[-1]}")
+        lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(state[-2])}")
+        lines.append(f"{self.name}_count{_labels(self.labels, key)} {state[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+# -------- Metrics shared by every entry point -------- #
+
+HTTP_REQUESTS = Counter(
+    "tkdl_http_requests_total", "HTTP requests handled, by route.", ("route", "method", "status"))
+HTTP_SECONDS = Histogram(
+    "tkdl_http_request_duration_seconds",
+    "Time until the response starts (streamed bodies continue after).", ("route", "method"))
+PROVIDER_SECONDS = Histogram(
+    "tkdl_provider_duration_seconds",
+    "Provider call latency by outcome (ok, error, cancelled).", ("provider", "outcome"))
+VIDEO_BYTES = Counter(
+    "tkdl_video_bytes_total",
+    "Video bytes relayed to clients (relayed) or saved to disk (saved).", ("direction", "source"))
+ACTIVE_STREAMS = Gauge("tkdl_active_streams", "Responses currently relaying video bytes.")
+CLEANUP_RUNS = Counter("tkdl_cleanup_runs_total", "Cleanup passes over the download folders.")
+CLEANUP_REMOVED = Counter("tkdl_cleanup_removed_total", "Files and temp dirs removed by cleanup.", ("kind",))
+CLEANUP_SECONDS = Histogram("tkdl_cleanup_duration_seconds", "Time spent in one cleanup pass.")
+
+
+def stats_gauge(name, help, stats, fields):
+    """
+    Export numeric `fields` of a stats() dict as one gauge labelled by
+    field, e.g. stats_gauge("tkdl_scheduler", ..., download_scheduler.stats,
+    ("running", "queued")).
+    """
+    def read():
+        data = stats()
+        return [((field,), data[field]) for field in fields if isinstance(data.get(field), (int, float))]
+    return GaugeFunc(name, help, ("field",), read)
+
+
+def instrument_flask(app):
+    """Count and time every request, and serve the registry at /metrics."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record(response):
+        started = g.pop("metrics_started", None)
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+        if started is not None:
+            HTTP_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
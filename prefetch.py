@@ -0,0 +1,260 @@
+"""
+Speculative download of previewed videos (opt-in: TKDL_PREFETCH=1).
+
+Nearly every /preview is followed by a download of the same video, so
+once a preview has resolved a URL its video is fetched into the app's
+video cache in the background. The download then finds it on local disk,
+or joins the fetch that is still running, instead of starting from the CDN.
+
+The speculation is bounded: at most TKDL_PREFETCH_ACTIVE fetches run at
+once (later previews are simply not prefetched), prefetched videos that
+nobody has downloaded yet take at most TKDL_PREFETCH_BYTES, and one that
+isn't downloaded within TKDL_PREFETCH_WINDOW seconds of its preview is
+cancelled mid-fetch, or dropped from the cache at the next preview.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from canonical import sanitize_url
+from metacache import metadata_cache
+from metrics import Counter
+from providers import forget_info, get_provider, info_key, save_stream
+from shared import STATE_DB, connect
+from videocache import FillCancelled, cache_name
+
+PREFETCH = os.environ.get("TKDL_PREFETCH", "0") == "1"
+MAX_ACTIVE = int(os.environ.get("TKDL_PREFETCH_ACTIVE", "2"))
+MAX_BYTES = int(os.environ.get("TKDL_PREFETCH_BYTES", 256 * 1024 ** 2))
+WINDOW = float(os.environ.get("TKDL_PREFETCH_WINDOW", "120"))
+
+PREFETCHES = Counter("tkdl_prefetch_total", "Background fetches of previewed videos, by outcome.",
+                     ("outcome",))
+
+
+class PrefetchCancelled(FillCancelled):
+    pass
+
+
+class _Prefetch:
+    def __init__(self, url):
+        self.url = url
+        self.started = time.time()
+        self.bytes = 0
+        self.claimed = False
+        self.filled = False  # written by us, not found in the cache
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+
+
+class Prefetcher:
+    """Background fetches of previewed videos into `cache` (see the module docstring)."""
+
+    def __init__(self, cache, enabled=PREFETCH, max_active=MAX_ACTIVE, max_bytes=MAX_BYTES, window=WINDOW):
+        self.cache = cache
+        self.enabled = enabled
+        self.max_active = max_active
+        self.max_bytes = max_bytes
+        self.window = window
+        self._entries = {}  # cache name -> _Prefetch
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_active), thread_name_prefix="prefetch")
+        self.counts = dict.fromkeys(("started", "used", "skipped", "cancelled", "expired", "failed"), 0)
+
+    def _count(self, outcome):
+        self.counts[outcome] += 1
+        PREFETCHES.inc(outcome=outcome)
+
+    def start(self, url):
+        """Fetch `url` in the background unless it's cached, already running or over budget."""
+        if not self.enabled or not url:
+            return False
+        self._expire()
+        name = cache_name(url)
+        # Only links a preview has just resolved: resolving is the upstream's
+        # job on a real download, not ours.
+        if not metadata_cache.get(info_key(url)) or self.cache.get(name):
+            return False
+        with self._lock:
+            if name in self._entries:
+                return False
+            active = sum(not e.done.is_set() for e in self._entries.values())
+            if active >= self.max_active or self._pending_bytes() >= self.max_bytes:
+                self._count("skipped")
+                return False
+            entry = self._entries[name] = _Prefetch(url)
+            self._count("started")
+        self._executor.submit(self._run, name, entry)
+        return True
+
+    def claim(self, url):
+        """
+        Note that `url` is being downloaded, so its prefetch is kept. Returns
+        the prefetch (done or still running) or None if there's none here.
+        """
+        if not self.enabled:
+            return None
+        name = cache_name(url)
+        self._mark_claimed(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if not entry.claimed:
+                entry.claimed = True
+                self._count("used")
+            if entry.done.is_set():
+                del self._entries[name]
+        return entry
+
+    def take(self, url):
+        """
+        Cache name of `url`'s video if it is on disk, waiting for a prefetch
+        still running; None if there's none and the caller should download it.
+        """
+        if not self.enabled:
+            return None
+        entry = self.claim(url)
+        if entry:
+            entry.done.wait()
+        return self.cache.get(cache_name(url))
+
+    def _run(self, name, entry):
+        try:
+            self.cache.fetch(name, lambda tmp: self._fill(entry, tmp))
+        except Exception as e:
+            with self._lock:
+                if self._entries.get(name) is entry:
+                    del self._entries[name]
+            if entry.cancel.is_set():
+                self._count("cancelled")
+            else:
+                self._count("failed")
+                print(f"[Prefetch] {name}: {e}")
+        else:
+            with self._lock:
+                if entry.claimed and self._entries.get(name) is entry:
+                    del self._entries[name]
+        finally:
+            entry.done.set()
+
+    def _fill(self, entry, filepath):
+        info = metadata_cache.get(info_key(entry.url))
+        if not info:
+            raise LookupError("metadata expired before the prefetch started")
+        try:
+            response = get_provider(info["provider"]).open_stream(info)
+            saved = save_stream(response, filepath, entry.cancel,
+                                lambda done, total: self._progress(entry, done, total))
+        except Exception:
+            forget_info(entry.url)  # probably a stale link; the download resolves again
+            raise
+        if not saved:
+            raise PrefetchCancelled(f"not downloaded within {self.window:g}s or over budget")
+        entry.filled = True
+        return True
+
+    def _progress(self, entry, done, total):
+        entry.bytes = max(done, total)
+        if entry.claimed:
+            return
+        with self._lock:
+            late = time.time() - entry.started > self.window
+            # Older prefetches keep their share of the budget.
+            over = self._pending_bytes(before=entry.started) > self.max_bytes
+        if (late or over) and not self._claimed_elsewhere(entry):
+            entry.cancel.set()
+
+    def _pending_bytes(self, before=None):
+        # Caller holds self._lock.
+        return sum(e.bytes for e in self._entries.values()
+                   if not e.claimed and (before is None or e.started <= before))
+
+    def _expire(self):
+        """Drop finished prefetches nobody downloaded within the window."""
+        now = time.time()
+        with self._lock:
+            stale = [(name, e) for name, e in self._entries.items()
+                     if e.done.is_set() and now - e.started > self.window]
+            for name, _ in stale:
+                del self._entries[name]
+        for name, entry in stale:
+            if entry.claimed or not entry.filled or self._claimed_elsewhere(entry):
+                continue
+            if self.cache.discard(name):
+                self._count("expired")
+                print(f"[Prefetch] Dropped {name}, not downloaded within {self.window:g}s")
+
+    def _mark_claimed(self, name):
+        pass
+
+    def _claimed_elsewhere(self, entry):
+        return False
+
+    def stats(self):
+        with self._lock:
+            active = sum(not e.done.is_set() for e in self._entries.values())
+            waiting = len(self._entries) - active
+            pending = self._pending_bytes()
+        return dict(self.counts, enabled=self.enabled, active=active, waiting=waiting,
+                    pending_bytes=pending, max_bytes=self.max_bytes, window=self.window)
+
+
+class SharedPrefetcher(Prefetcher):
+    """
+    Prefetcher for worker processes sharing a state file (see shared.py).
+    Downloads are noted in the file, so a prefetch is kept when another
+    worker got the download request.
+    """
+
+    def __init__(self, cache, db_path, **kwargs):
+        super().__init__(cache, **kwargs)
+        self.db_path = db_path
+        self.folder_key = os.path.abspath(cache.folder)
+        connect(db_path).execute("CREATE TABLE IF NOT EXISTS prefetch_claims (folder TEXT, name TEXT,"
+                                 " claimed REAL, PRIMARY KEY (folder, name))")
+
+    def _mark_claimed(self, name):
+        now = time.time()
+        db = connect(self.db_path)
+        db.execute("INSERT OR REPLACE INTO prefetch_claims VALUES (?, ?, ?)", (self.folder_key, name, now))
+        db.execute("DELETE FROM prefetch_claims WHERE claimed < ?", (now - 2 * self.window,))
+
+    def _claimed_elsewhere(self, entry):
+        row = connect(self.db_path).execute(
+            "SELECT 1 FROM prefetch_claims WHERE folder = ? AND name = ? AND claimed >= ?",
+            (self.folder_key, cache_name(entry.url), entry.started)).fetchone()
+        if row:
+            entry.claimed = True
+        return bool(row)
+
+
+def open_prefetcher(cache):
+    """Prefetcher for `cache`: downloads are noted across processes when TKDL_STATE_DB is set."""
+    if STATE_DB:
+        return SharedPrefetcher(cache, STATE_DB)
+    return Prefetcher(cache)
+
+
+def prefetch_flask(app):
+    """Start a prefetch after each successful POST /preview of `app` (when enabled)."""
+    from flask import request
+
+    prefetcher = app.extensions["prefetch"]
+    if not prefetcher.enabled:
+        return
+
+    @app.after_request
+    def _prefetch_previewed(response):
+        if request.method != "POST" or request.path != "/preview" or response.status_code != 200:
+            return response
+        body = response.get_json(silent=True) if response.is_json else None
+        if not body or "error" in body or body.get("success") is False:
+            return response
+        data = request.form or request.get_json(silent=True) or {}
+        try:
+            prefetcher.start(sanitize_url(data.get("url")))
+        except Exception as e:
+            print(f"[Prefetch] {e}")
+        return response
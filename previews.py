@@ -0,0 +1,141 @@
+"""
+Metadata lookups for /preview, which the pages call on every pause in
+typing, so one client's previews overlap and go stale before they finish.
+
+Previews of the same video that are in flight together share one
+resolution. A newer preview from the same page supersedes its older
+ones: they return at once with Superseded (409), and a resolution
+nobody is waiting for any more is cancelled before it tries another
+provider. Pages name themselves with a random X-Preview-Session header;
+the client address won't do, since users behind one NAT or proxy share
+it. Requests without the header are coalesced but never superseded.
+Previews only ever resolve metadata; the video bytes are fetched by the
+download (or by prefetch.py), never by a preview.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metacache import cache_key, metadata_cache
+from metrics import Counter
+from providers import info_key, video_info
+from tracing import in_context
+
+PREVIEW_WORKERS = int(os.environ.get("TKDL_PREVIEW_WORKERS", "16"))
+SESSION_HEADER = "X-Preview-Session"
+
+PREVIEWS = Counter("tkdl_previews_total", "Preview lookups by outcome.", ("outcome",))
+
+
+class Superseded(Exception):
+    def __init__(self):
+        super().__init__("superseded by a newer preview")
+
+
+class _Waiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.superseded = False
+
+
+class _Lookup:
+    def __init__(self):
+        self.cancel = threading.Event()
+        self.waiters = set()
+        self.result = None
+        self.error = None
+
+
+class PreviewLookups:
+    """Coalesced, supersedable `resolve(url, cancel)` calls (see the module docstring)."""
+
+    def __init__(self, resolve=video_info, workers=PREVIEW_WORKERS):
+        self.resolve = resolve
+        self._latest = {}  # session -> its newest _Waiter
+        self._lookups = {}  # cache key -> _Lookup in flight
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preview")
+        self.counts = dict.fromkeys(("cached", "resolved", "coalesced", "superseded", "cancelled"), 0)
+
+    def _count(self, outcome):
+        self.counts[outcome] += 1
+        PREVIEWS.inc(outcome=outcome)
+
+    def get(self, url, session=None):
+        """Metadata for `session`'s preview of `url`; raises Superseded if it sends a newer one first."""
+        waiter = _Waiter()
+        info = metadata_cache.get(info_key(url))
+        key = cache_key(url)
+        with self._lock:
+            previous = self._latest.get(session) if session else None
+            if previous is not None:
+                previous.superseded = True
+                previous.event.set()
+            if info is not None:
+                self._count("cached")
+                return info
+            if session:
+                self._latest[session] = waiter
+            lookup = self._lookups.get(key)
+            if lookup is None or lookup.cancel.is_set():
+                lookup = self._lookups[key] = _Lookup()
+                self._executor.submit(in_context(self._run), key, lookup, url)
+                self._count("resolved")
+            else:
+                self._count("coalesced")
+            lookup.waiters.add(waiter)
+        try:
+            waiter.event.wait()
+        finally:
+            with self._lock:
+                lookup.waiters.discard(waiter)
+                if session and self._latest.get(session) is waiter:
+                    del self._latest[session]
+                if not lookup.waiters and self._lookups.get(key) is lookup:
+                    # Still resolving and nobody wants the answer.
+                    lookup.cancel.set()
+                    self._count("cancelled")
+        if waiter.superseded:
+            self._count("superseded")
+            raise Superseded()
+        if lookup.error:
+            raise lookup.error
+        return lookup.result
+
+    def _run(self, key, lookup, url):
+        try:
+            lookup.result = self.resolve(url, cancel=lookup.cancel)
+        except Exception as e:
+            lookup.error = e
+        finally:
+            with self._lock:
+                if self._lookups.get(key) is lookup:
+                    del self._lookups[key]
+                waiters = list(lookup.waiters)
+            for waiter in waiters:
+                waiter.event.set()
+
+    def stats(self):
+        with self._lock:
+            inflight = len(self._lookups)
+        return dict(self.counts, inflight=inflight)
+
+
+preview_lookups = PreviewLookups()
+
+
+def preview_session(req):
+    """The page a /preview request `req` (Flask or Starlette) came from, or None."""
+    return (req.headers.get(SESSION_HEADER) or "")[:64] or None
+
+
+def preview_info(url, session=None):
+    """video_info(url) for a /preview from page `session` (see the module docstring)."""
+    return preview_lookups.get(url, session)
+
+
+def superseded_response(error):
+    from flask import jsonify
+    response = jsonify({"error": str(error)})
+    response.status_code = 409
+    return response
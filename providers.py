@@ -0,0 +1,338 @@
+"""
+Video providers behind one interface, shared by every entry point.
+
+A provider turns a TikTok page URL into video metadata ("resolve") and
+opens the video bytes for that metadata ("open_stream"). TikWM, SnapTik
+and yt-dlp are the built-in plugins; `register_provider` adds more and
+TKDL_PROVIDERS (e.g. "tikwm,yt-dlp") picks which run and in what order.
+
+Everything on top — metadata cache, hedged resolution, circuit breakers,
+the shared HTTP pool, download fallbacks — lives here once instead of in
+each script.
+"""
+import asyncio
+import os
+
+from canonical import sanitize_url  # the scripts import it from here
+from health import NotFound
+from httppool import http_session
+from metacache import metadata_cache, cache_key
+from metrics import VIDEO_BYTES
+from resolvers import ResolverEngine
+from streaming import chunk_size_for, preallocate
+from tracing import span
+from ytdlp_worker import ytdlp_pool
+
+# Overridable so benchmarks can point the plugins at a local stand-in.
+TIKWM_API = os.environ.get("TKDL_TIKWM_API", "https://www.tikwm.com/api/")
+SNAPTIK_API = os.environ.get("TKDL_SNAPTIK_API", "https://api.snaptik.app/api/v1/fetch")
+
+# Capabilities a provider can advertise.
+TITLE = "title"
+AUTHOR = "author"
+THUMBNAIL = "thumbnail"
+NEEDS_HEADERS = "needs-headers"  # video_url only works with info["headers"]
+
+
+class Provider:
+    """
+    Base class for providers. Subclasses describe their metadata call with
+    `api_request` + `parse` (so the same code serves requests and the async
+    client) or override `resolve`/`aresolve` entirely.
+
+    Metadata is a dict with "video_url" and, where known, "thumb_url",
+    "title", "author" and "headers" (sent with the video request).
+    """
+
+    name = None
+    capabilities = frozenset()
+    # Relative price of one call (quota, CPU, latency); cheaper providers
+    # are tried first until measured latency says otherwise.
+    cost = 1.0
+
+    def api_request(self, url):
+        """(method, api_url, kwargs) for the metadata call."""
+        raise NotImplementedError
+
+    def parse(self, payload):
+        """Metadata from the decoded JSON response, or None."""
+        raise NotImplementedError
+
+    def resolve(self, url, cancel=None):
+        method, api_url, kwargs = self.api_request(url)
+        res = http_session.request(method, api_url, **kwargs)
+        res.raise_for_status()
+        return self._tag(self.parse(res.json()), url)
+
+    async def aresolve(self, url, client):
+        """resolve() with an httpx.AsyncClient."""
+        method, api_url, kwargs = self.api_request(url)
+        res = await client.request(method, api_url, **kwargs)
+        res.raise_for_status()
+        return self._tag(self.parse(res.json()), url)
+
+    def _tag(self, info, url):
+        """`info` marked as ours; NotFound if the provider answered without a video."""
+        if info and info.get("video_url"):
+            info["provider"] = self.name
+            return info
+        raise NotFound(f"no video for {url}")
+
+    def open_stream(self, info, headers=None, timeout=30):
+        """Streaming GET of the video; `headers` (e.g. Range) are added to the provider's own."""
+        send = dict(info.get("headers") or {})
+        send.update(headers or {})
+        return http_session.get(info["video_url"], stream=True, headers=send, timeout=timeout)
+
+    def download(self, url, filepath, cancel=None, progress=None):
+        """Resolve and save `url` to `filepath`; False if cancelled halfway."""
+        info = self.resolve(url, cancel)
+        if not info:
+            return False
+        return save_stream(self.open_stream(info), filepath, cancel, progress)
+
+    def describe(self):
+        return {"capabilities": sorted(self.capabilities), "cost": self.cost}
+
+
+class TikWMProvider(Provider):
+    name = "tikwm"
+    capabilities = frozenset({TITLE, AUTHOR, THUMBNAIL})
+    cost = 1.0
+
+    def api_request(self, url):
+        return "POST", TIKWM_API, {"data": {"url": url}, "timeout": 15}
+
+    # Messages of TikWM's non-zero codes that mean the link leads to no video.
+    # Anything else (e.g. "Free Api Limit", a 200 with code -1) is a failure.
+    NOT_FOUND_MESSAGES = ("url parsing is failed", "video not found", "video is unavailable",
+                          "video currently unavailable", "has been deleted", "is private")
+
+    def parse(self, payload):
+        code = payload.get("code")
+        if code != 0:
+            message = str(payload.get("msg") or "")
+            if any(m in message.lower() for m in self.NOT_FOUND_MESSAGES):
+                raise NotFound(f"tikwm: {message}")
+            raise Exception(f"tikwm answered code {code}: {message or 'no message'}")
+        if not payload.get("data"):
+            return None
+        data = payload["data"]
+        return {
+            "video_url": data.get("play"),
+            "thumb_url": data.get("cover"),
+            "title": data.get("title"),
+            "author": (data.get("author") or {}).get("unique_id"),
+        }
+
+
+class SnapTikProvider(Provider):
+    name = "snaptik"
+    capabilities = frozenset({THUMBNAIL})
+    cost = 1.0
+
+    def api_request(self, url):
+        return "GET", SNAPTIK_API, {"params": {"url": url}, "timeout": 15}
+
+    def parse(self, payload):
+        video = payload.get("video")
+        if isinstance(video, dict) and video.get("urls"):
+            video_url = video["urls"][0]
+        elif isinstance(video, str):
+            video_url = video
+        else:
+            return None
+        return {"video_url": video_url, "thumb_url": payload.get("cover")}
+
+
+class YtDlpProvider(Provider):
+    name = "yt-dlp"
+    capabilities = frozenset({TITLE, AUTHOR, THUMBNAIL, NEEDS_HEADERS})
+    # Runs the extractor in-process and needs the cookie jar.
+    cost = 3.0
+
+    def resolve(self, url, cancel=None):
+        try:
+            info = ytdlp_pool.extract(url)
+        except Exception as e:
+            # yt-dlp marks errors about the video itself (unavailable,
+            # private, unsupported URL) as expected.
+            cause = (getattr(e, "exc_info", None) or (None, None))[1]
+            if getattr(cause, "expected", False):
+                raise NotFound(str(e)) from e
+            raise
+        headers = dict(info.get("http_headers") or {})
+        if info.get("cookie_header"):
+            headers["Cookie"] = info["cookie_header"]
+        return self._tag({
+            "video_url": info.get("url"),
+            "thumb_url": info.get("thumbnail"),
+            "title": info.get("title"),
+            "author": info.get("uploader"),
+            "headers": headers,
+        }, url)
+
+    async def aresolve(self, url, client):
+        # YoutubeDL is blocking; run it on a thread with a warm instance.
+        return await asyncio.to_thread(self.resolve, url)
+
+
+_registry = {}
+
+
+def register_provider(provider):
+    """Make `provider` available by name (replacing one with the same name)."""
+    _registry[provider.name] = provider
+    return provider
+
+
+for _provider in (TikWMProvider(), SnapTikProvider(), YtDlpProvider()):
+    register_provider(_provider)
+
+
+def enabled_providers():
+    """Providers named in TKDL_PROVIDERS (in that order), else all by cost."""
+    names = os.environ.get("TKDL_PROVIDERS")
+    if names:
+        return [_registry[n.strip()] for n in names.split(",") if n.strip() in _registry]
+    return sorted(_registry.values(), key=lambda p: p.cost)
+
+
+def get_provider(name):
+    return _registry[name]
+
+
+def providers_with(capability):
+    return [p for p in enabled_providers() if capability in p.capabilities]
+
+
+# -------- Shared resolution and download -------- #
+
+def save_stream(response, filepath, cancel=None, progress=None):
+    """Write a streaming response to `filepath`; False if cancelled halfway."""
+    with response, span("cdn_fetch") as trace:
+        response.raise_for_status()
+        total = int(response.headers.get("Content-Length") or 0)
+        chunk_size = chunk_size_for(total)
+        done = 0
+        with open(filepath, "wb") as f:
+            preallocate(f, total)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if cancel is not None and cancel.is_set():
+                    trace.set(bytes=done, cancelled=True)
+                    return False
+                f.write(chunk)
+                done += len(chunk)
+                VIDEO_BYTES.inc(len(chunk), direction="saved", source="cdn")
+                if progress:
+                    progress(done, total)
+            if done != total:
+                f.truncate(done)  # shorter than announced (or compressed)
+        trace.set(bytes=done, chunk=chunk_size)
+    return True
+
+
+def into_part_file(provider):
+    """
+    Adapt `provider.download` for the download engine: write to
+    `<filepath>.<name>` and return that path, so providers can race.
+    """
+    def download(url, filepath, cancel=None, progress=None):
+        part = f"{filepath}.{provider.name}"
+        try:
+            if provider.download(url, part, cancel, progress):
+                return part
+        except Exception:
+            remove_quietly(part)
+            raise
+        remove_quietly(part)
+        return None
+    return download
+
+
+def remove_quietly(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+info_engine = ResolverEngine([(p.name, p.resolve) for p in enabled_providers()])
+# Whole downloads are never hedged or raced, that would fetch the video
+# twice exactly when the CDN is slow; they're only the fallback, one
+# provider after another, when the winning lookup's link fails.
+download_engine = ResolverEngine([(p.name, into_part_file(p)) for p in enabled_providers()],
+                                 mode="sequential")
+
+
+def info_key(url):
+    return f"info:{cache_key(url)}"
+
+
+def video_info(url, cancel=None, outcomes=None):
+    """
+    Metadata for `url` from the first provider to answer (cached, see
+    metacache.py). Setting `cancel` stops a resolution that's under way.
+    On a miss, each provider call's outcome is appended to `outcomes`.
+    """
+    return metadata_cache.lookup(url, lambda u: _resolve_info(u, cancel, outcomes), namespace="info")
+
+
+def _resolve_info(url, cancel=None, outcomes=None):
+    # Only runs on cache misses.
+    with span("resolve"):
+        return info_engine.resolve(url, cancel=cancel, outcomes=outcomes)
+
+
+def forget_info(url):
+    """Drop cached metadata, e.g. after its signed video URL stopped working."""
+    metadata_cache.discard(info_key(url))
+
+
+def open_video(url, headers=None):
+    """(info, streaming response) for `url`, re-resolving once if the cached link is stale."""
+    for attempt in range(2):
+        info = video_info(url)
+        if not info:
+            raise Exception("no provider could resolve the video")
+        try:
+            r = get_provider(info["provider"]).open_stream(info, headers)
+            if r.status_code in (401, 403, 404, 410) and attempt == 0:
+                r.close()
+                forget_info(url)
+                continue
+            return info, r
+        except Exception:
+            forget_info(url)
+            if attempt:
+                raise
+    raise Exception("video link expired")
+
+
+def fetch_video(url, filepath, progress=None):
+    """
+    Download `url` into `filepath`. Only the metadata lookup is hedged
+    (video_info, usually cached by a preview); the bytes come once, from
+    the winner's link. If that fails, the providers' own downloads are
+    tried one after another. Raises if all of them fail.
+    """
+    info = video_info(url)
+    if info:
+        try:
+            provider = get_provider(info["provider"])
+            if save_stream(provider.open_stream(info), filepath, progress=progress):
+                return True
+        except Exception as e:
+            print(f"[{info['provider']} error] cached link failed: {e}")
+            forget_info(url)
+    part = download_engine.resolve(url, filepath, discard=remove_quietly, progress=progress)
+    if not part:
+        raise Exception("all download methods failed")
+    os.replace(part, filepath)
+    return True
+
+
+def stats():
+    return {
+        "providers": {p.name: p.describe() for p in enabled_providers()},
+        "metadata": info_engine.stats(),
+        "downloads": download_engine.stats(),
+    }
@@ -0,0 +1,190 @@
+"""
+Token-bucket rate limits, for two things:
+
+  clients   each caller (IP) may make requests that can reach upstream (POSTs,
+            GET /stream, cover fetches) at TKDL_CLIENT_RATE per second with
+            bursts of TKDL_CLIENT_BURST; beyond that they get 429 + Retry-After
+  upstream  calls to each provider are spaced to the budget in
+            TKDL_UPSTREAM_RATES, e.g. "tikwm=1,snaptik=5,yt-dlp=2"; a call
+            waits up to TKDL_BUDGET_WAIT seconds for its turn, otherwise the
+            provider is skipped for that request like an open circuit
+
+Buckets live in memory by default. Set TKDL_RATELIMIT_DB to a SQLite file
+to share them between worker processes on one host (serve.py's shared
+state file, TKDL_STATE_DB, is used when set).
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter
+from shared import STATE_DB, connect, transaction
+
+CLIENT_RATE = float(os.environ.get("TKDL_CLIENT_RATE", "3"))
+CLIENT_BURST = float(os.environ.get("TKDL_CLIENT_BURST", "30"))
+# Requests per second (burst = BUDGET_BURST seconds' worth) per provider; 0 = unlimited.
+UPSTREAM_RATES = os.environ.get("TKDL_UPSTREAM_RATES", "tikwm=1")
+BUDGET_BURST = 5
+BUDGET_WAIT = float(os.environ.get("TKDL_BUDGET_WAIT", "1.0"))
+RATELIMIT_DB = os.environ.get("TKDL_RATELIMIT_DB", STATE_DB)
+MAX_BUCKETS = 100_000
+
+RATE_LIMITED = Counter("tkdl_rate_limited_total", "Calls refused or delayed by a rate limit.",
+                       ("scope", "outcome"))
+
+
+def parse_rates(text):
+    rates = {}
+    for item in (text or "").split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def take_token(state, now, rate, burst, max_wait):
+    """
+    Refill `state` = (tokens, updated) and take one token, allowing a debt
+    of up to `max_wait` seconds. Returns (new state or None, wait): the new
+    state to store and how long to wait before going ahead, or None and
+    how long until a token is free if the caller may not go.
+    """
+    tokens, updated = state if state else (burst, now)
+    tokens = min(burst, tokens + (now - updated) * rate) - 1
+    wait = -tokens / rate if tokens < 0 else 0.0
+    if wait > max_wait:
+        return None, wait
+    return (tokens, now), wait
+
+
+class MemoryBuckets:
+    """Buckets in this process; least recently used ones are dropped past `max_keys`."""
+
+    def __init__(self, max_keys=MAX_BUCKETS):
+        self.max_keys = max_keys
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, max_wait=0.0):
+        with self._lock:
+            state, wait = take_token(self._state.get(key), time.time(), rate, burst, max_wait)
+            if state:
+                self._state[key] = state
+                self._state.move_to_end(key)
+                while len(self._state) > self.max_keys:
+                    self._state.popitem(last=False)
+            return state is not None, wait
+
+    def __len__(self):
+        return len(self._state)
+
+
+class SqliteBuckets:
+    """The same buckets in a SQLite file (WAL), shared by every process that opens it."""
+
+    def __init__(self, path):
+        self.path = path
+        connect(path).execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def take(self, key, rate, burst, max_wait=0.0):
+        with transaction(self.path) as db:
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            state, wait = take_token(row, time.time(), rate, burst, max_wait)
+            if state:
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, *state))
+        return state is not None, wait
+
+    def __len__(self):
+        return connect(self.path).execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+buckets = SqliteBuckets(RATELIMIT_DB) if RATELIMIT_DB else MemoryBuckets()
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__("rate limit exceeded")
+        self.retry_after = retry_after
+
+
+class UpstreamBudget:
+    """Per-provider request budgets (see the module docstring)."""
+
+    def __init__(self, rates, store=buckets, max_wait=BUDGET_WAIT):
+        self.rates = rates
+        self.store = store
+        self.max_wait = max_wait
+        self.delayed = 0
+        self.refused = 0
+
+    def reserve(self, name):
+        """Seconds to wait before calling provider `name`; raises RateLimited if too long."""
+        rate = self.rates.get(name)
+        if not rate:
+            return 0.0
+        allowed, wait = self.store.take(f"upstream:{name}", rate, rate * BUDGET_BURST, self.max_wait)
+        if not allowed:
+            self.refused += 1
+            RATE_LIMITED.inc(scope=name, outcome="refused")
+            raise RateLimited(math.ceil(wait))
+        if wait:
+            self.delayed += 1
+            RATE_LIMITED.inc(scope=name, outcome="delayed")
+        return wait
+
+    def acquire(self, name):
+        """Blocking reserve(): returns once the call may go ahead."""
+        wait = self.reserve(name)
+        if wait:
+            time.sleep(wait)
+
+    def stats(self):
+        return {"rates": self.rates, "delayed": self.delayed, "refused": self.refused}
+
+
+upstream_budget = UpstreamBudget(parse_rates(UPSTREAM_RATES))
+
+
+def check_client(client, rate=CLIENT_RATE, burst=CLIENT_BURST):
+    """Raise RateLimited if `client` is over its request rate."""
+    if not rate:
+        return
+    allowed, wait = buckets.take(f"client:{client}", rate, burst)
+    if not allowed:
+        RATE_LIMITED.inc(scope="client", outcome="refused")
+        raise RateLimited(math.ceil(wait))
+
+
+def limit_flask(app, get_paths=("/stream",)):
+    """
+    Apply the per-client limit to the requests of `app` that reach upstream:
+    every POST and GETs of `get_paths`. /thumb checks it itself, on a
+    cache miss (see thumbs.py).
+    """
+    from flask import request
+    from scheduler import client_id
+
+    @app.before_request
+    def _limit_client():
+        if request.method != "POST" and request.path not in get_paths:
+            return None
+        try:
+            check_client(client_id(request))
+        except RateLimited as e:
+            return limited_response(e)
+        return None
+
+
+def limited_response(error):
+    from flask import jsonify
+    response = jsonify({"error": "Too many requests, please slow down."})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def stats():
+    return dict(upstream_budget.stats(), buckets=len(buckets),
+                client_rate=CLIENT_RATE, shared=bool(RATELIMIT_DB))
@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from health import PROBE, is_failure, provider_health
+from metrics import PROVIDER_SECONDS
+from ratelimit import RateLimited, upstream_budget
+from tracing import in_context, span
+
+# sequential: try providers one after another (the old behaviour)
+# hedged:     start the next provider if the current one hasn't answered
+#             within HEDGE_DELAY seconds, or as soon as it fails
+# race:       start every provider at once
+RESOLVE_MODE = os.environ.get("TKDL_RESOLVE_MODE", "hedged")
+HEDGE_DELAY = float(os.environ.get("TKDL_HEDGE_DELAY", "2.5"))
+
+# A failed attempt counts as at least this slow when ranking providers.
+FAILURE_PENALTY = 10.0
+EWMA_ALPHA = 0.3
+
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="resolver")
+
+
+class ResolverEngine:
+    """
+    Runs a list of named providers for one request and returns the first
+    valid result. Providers are called as `fn(*args, cancel=event)` and
+    should return a result, or None / raise on failure; long-running ones
+    should stop when `cancel` is set. If the caller passes `progress`, it
+    is forwarded to the providers as a keyword argument too.
+
+    Providers are tried fastest-first according to an exponentially
+    weighted average of their recent latency, and skipped outright while
+    their circuit breaker is open (see health.py).
+    """
+
+    def __init__(self, providers, mode=None, hedge_delay=None):
+        self.providers = list(providers)
+        self.mode = mode or RESOLVE_MODE
+        self.hedge_delay = HEDGE_DELAY if hedge_delay is None else hedge_delay
+        self.latency = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            prev = self.latency.get(name)
+            self.latency[name] = seconds if prev is None else (
+                EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * prev
+            )
+
+    def ordered(self):
+        """Providers sorted by observed latency; untried ones go first so they get measured."""
+        with self._lock:
+            latency = dict(self.latency)
+        return sorted(self.providers, key=lambda p: latency.get(p[0], 0.0))
+
+    def _attempt(self, name, fn, probe, args, cancel, extra, outcomes):
+        with span("provider", provider=name) as trace:
+            health = provider_health(name)
+            try:
+                upstream_budget.acquire(name)
+            except RateLimited:
+                # Out of budget: skip it for this request, it isn't broken.
+                health.release(probe)
+                trace.set(outcome="throttled")
+                outcomes.append("throttled")
+                return None
+            started = time.monotonic()
+            failed = True
+            try:
+                result = fn(*args, cancel=cancel, **extra)
+            except Exception as e:
+                failed = is_failure(e)
+                if failed:
+                    print(f"[{name} error] {e}")
+                result = None
+            elapsed = time.monotonic() - started
+            if result:
+                self.record(name, elapsed)
+                health.record(True, elapsed, probe)
+                outcome = "ok"
+            elif not failed:
+                # "No such video": the provider works, the URL is just bad.
+                self.record(name, elapsed)
+                health.record(True, elapsed, probe)
+                outcome = "not_found"
+            elif cancel.is_set():
+                # Cancelled because another provider won: it was at least this
+                # slow, but we learned nothing about whether it works.
+                self.record(name, elapsed)
+                health.release(probe)
+                outcome = "cancelled"
+            else:
+                self.record(name, max(elapsed, FAILURE_PENALTY))
+                health.record(False, elapsed, probe)
+                outcome = "error"
+            PROVIDER_SECONDS.observe(elapsed, provider=name, outcome=outcome)
+            trace.set(outcome=outcome)
+            outcomes.append(outcome)
+            return result
+
+    @staticmethod
+    def _next_allowed(queue):
+        """Pop providers off `queue` until one whose circuit lets a call through: (name, fn, probe)."""
+        while queue:
+            name, fn = queue.pop(0)
+            allowed = provider_health(name).allow()
+            if allowed:
+                return name, fn, allowed == PROBE
+        return None
+
+    def resolve(self, *args, discard=None, progress=None, cancel=None, outcomes=None):
+        """
+        Return the first valid provider result for `args`, or None.
+        `discard(result)` is called for successful results that lost the
+        race (e.g. to delete a file the loser already wrote). Setting
+        `cancel` gives up: no more providers are started and the running
+        ones are asked to stop. Each call's outcome ("ok", "not_found",
+        "error", ...) is appended to `outcomes` if given.
+        """
+        outcomes = [] if outcomes is None else outcomes
+        queue = self.ordered()
+        extra = {"progress": progress} if progress else {}
+        cancel = cancel or threading.Event()
+        if self.mode == "sequential":
+            while queue and not cancel.is_set():
+                provider = self._next_allowed(queue)
+                if provider is None:
+                    break
+                result = self._attempt(*provider, args, cancel, extra, outcomes)
+                if result:
+                    return result
+            return None
+
+        pending = {}
+        names = {}
+        probes = {}
+        winner = []
+
+        def launch():
+            if cancel.is_set():
+                return
+            provider = self._next_allowed(queue)
+            if provider is None:
+                return
+            future = _executor.submit(in_context(self._attempt), *provider, args, cancel, extra, outcomes)
+            pending[future] = names[future] = provider[0]
+            probes[future] = provider[2]
+
+        def cleanup(future):
+            if future.cancelled():
+                # Never ran, so give back a half-open probe slot if it held one.
+                provider_health(names[future]).release(probes[future])
+                return
+            if future in winner:
+                return
+            result = future.result()
+            if result and discard:
+                discard(result)
+
+        launch()
+        while queue and self.mode == "race":
+            launch()
+
+        while pending:
+            timeout = self.hedge_delay if queue else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                launch()  # hedge: current providers are slow
+                continue
+            for future in done:
+                del pending[future]
+                if future.result() and not winner:
+                    winner.append(future)
+            if winner:
+                cancel.set()
+                for future in list(pending) + list(done):
+                    future.cancel()
+                    future.add_done_callback(cleanup)
+                return winner[0].result()
+            if cancel.is_set():
+                # Given up by the caller: let the rest finish on their own.
+                for future in pending:
+                    future.cancel()
+                    future.add_done_callback(cleanup)
+                return None
+            if queue:
+                launch()  # something failed, don't wait for the hedge timer
+        return None
+
+    def stats(self):
+        order = [name for name, _ in self.ordered()]
+        with self._lock:
+            latency = {k: round(v, 3) for k, v in self.latency.items()}
+        return {
+            "mode": self.mode,
+            "hedge_delay": self.hedge_delay,
+            "order": order,
+            "latency": latency,
+            "health": {name: provider_health(name).stats() for name in order},
+        }
@@ -0,0 +1,152 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from flask import jsonify
+
+from tracing import in_context, record_span
+
+WORKERS = int(os.environ.get("TKDL_DOWNLOAD_WORKERS", "4"))
+# Downloads waiting for a worker, across all clients...
+MAX_QUEUE = int(os.environ.get("TKDL_DOWNLOAD_QUEUE", "32"))
+# ...and per client, so one client can't fill the queue for everyone.
+PER_CLIENT_QUEUE = int(os.environ.get("TKDL_CLIENT_QUEUE", "4"))
+# Reverse proxies in front of the app that append to X-Forwarded-For. With
+# 0 the header is ignored, since any client can send one.
+TRUSTED_PROXIES = int(os.environ.get("TKDL_TRUSTED_PROXIES", "0"))
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("download queue is full")
+        self.retry_after = retry_after
+
+
+class DownloadScheduler:
+    """
+    Fixed pool of download workers fed from a bounded queue.
+
+    Each client gets its own FIFO and workers take jobs from the clients
+    in turn, so one client submitting many downloads can't starve the
+    others. When the queue (or a client's share of it) is full, submit()
+    raises QueueFull with a Retry-After estimate instead of piling up
+    threads.
+    """
+
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE, per_client=PER_CLIENT_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self._queues = OrderedDict()  # client -> deque of jobs, in serving order
+        self._queued = 0
+        self._running = 0
+        self._avg_seconds = 5.0
+        self.completed = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"download-{i}", daemon=True).start()
+
+    def retry_after(self):
+        """Rough seconds until a queue slot frees up."""
+        waves = (self._queued + self._running) / max(self.workers, 1)
+        return max(1, math.ceil(waves * self._avg_seconds))
+
+    def submit(self, client, fn, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            queue = self._queues.get(client)
+            if self._queued >= self.max_queue or (queue and len(queue) >= self.per_client):
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            if queue is None:
+                queue = self._queues[client] = deque()
+            queued_at = time.monotonic()
+
+            def call():
+                record_span("queue_wait", time.monotonic() - queued_at)
+                return fn(*args, **kwargs)
+
+            # Runs on a worker thread, under the submitting request's trace.
+            queue.append((future, in_context(call), (), {}))
+            self._queued += 1
+            self._cond.notify()
+        return future
+
+    def run(self, client, fn, *args, **kwargs):
+        """submit() and wait for the result."""
+        return self.submit(client, fn, *args, **kwargs).result()
+
+    def _next_job(self):
+        # Caller holds self._cond. Round-robin: serve the client at the front,
+        # then move it to the back if it still has work queued.
+        client, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        del self._queues[client]
+        if queue:
+            self._queues[client] = queue
+        self._queued -= 1
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                future, fn, args, kwargs = self._next_job()
+                self._running += 1
+            started = time.monotonic()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                elapsed = time.monotonic() - started
+                with self._cond:
+                    self._running -= 1
+                    self.completed += 1
+                    self._avg_seconds = 0.2 * elapsed + 0.8 * self._avg_seconds
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "clients_waiting": len(self._queues),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_seconds": round(self._avg_seconds, 3),
+            }
+
+
+def forwarded_client(forwarded, remote, trusted=TRUSTED_PROXIES):
+    """
+    The caller's address: the X-Forwarded-For hop added by the outermost of
+    our `trusted` proxies (like werkzeug's ProxyFix), else the peer address.
+    """
+    hops = [hop.strip() for hop in (forwarded or "").split(",") if hop.strip()]
+    if trusted and len(hops) >= trusted:
+        return hops[-trusted]
+    return remote or "unknown"
+
+
+def client_id(req):
+    """Identify the caller of a Flask request (see forwarded_client)."""
+    return forwarded_client(req.headers.get("X-Forwarded-For"), req.remote_addr)
+
+
+def busy_response(error):
+    response = jsonify({"error": "Server is busy, please retry shortly."})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+download_scheduler = DownloadScheduler()
@@ -0,0 +1,129 @@
+"""
+Production launcher: run a tkdl variant as N worker processes on one port.
+
+    python serve.py tkdl1 --workers 4 --port 8000
+    python serve.py tkdl_async --workers 4
+
+The workers share a SQLite state file (TKDL_STATE_DB, default
+tkdl-state.db next to this file; see shared.py) for the video cache
+index and in-flight downloads, the /jobs table, the file expiry index
+and the rate-limit buckets, so a video is downloaded once whichever
+worker gets the request, and exactly one worker deletes expired files.
+
+Flask variants: this process binds the socket and the workers accept on
+it, each with a threaded Werkzeug server; dead workers are restarted.
+tkdl_async is handed to uvicorn's own multi-worker mode.
+"""
+import argparse
+import importlib
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VARIANTS = ("tkdl", "tkdl1", "tkdl2", "tkdl4", "tkdl5", "tkdl-dmode", "tkdlmerged", "tkdl_async")
+RESTART_DELAY = 1.0
+STARTUP_TIMEOUT = 60
+
+
+def run_worker(variant, host, port, fd, ready_fd):
+    """Serve `variant` on the inherited socket `fd` (runs in a worker process)."""
+    from werkzeug.serving import make_server
+
+    app = importlib.import_module(variant).app
+    server = make_server(host, port, app, threaded=True, fd=fd)
+    os.write(ready_fd, b".")
+    os.close(ready_fd)
+    server.serve_forever()
+
+
+def spawn(variant, host, port, fd, ready_fd):
+    cmd = [sys.executable, os.path.abspath(__file__), variant, "--host", host, "--port", str(port),
+           "--worker-fd", str(fd), "--ready-fd", str(ready_fd)]
+    return subprocess.Popen(cmd, cwd=BASE_DIR, pass_fds=(fd, ready_fd))
+
+
+def wait_ready(ready_r, workers, timeout=STARTUP_TIMEOUT):
+    """Block until `workers` workers have imported the app (or `timeout` passes)."""
+    deadline = time.monotonic() + timeout
+    ready = 0
+    while ready < workers and time.monotonic() < deadline:
+        if select.select([ready_r], [], [], deadline - time.monotonic())[0]:
+            data = os.read(ready_r, workers)
+            if not data:
+                break
+            ready += len(data)
+    return ready
+
+
+def supervise(variant, host, port, workers):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    fd = sock.fileno()
+    ready_r, ready_w = os.pipe()
+    os.set_inheritable(ready_w, True)
+
+    procs = [spawn(variant, host, port, fd, ready_w) for _ in range(workers)]
+    # Only accept connections once the workers can take them.
+    ready = wait_ready(ready_r, workers)
+    sock.listen(1024)
+    print(f"[serve] {variant} on http://{host}:{port} with {ready}/{workers} workers ready")
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        while not stopping:
+            for i, proc in enumerate(procs):
+                if proc.poll() is not None:
+                    print(f"[serve] worker {proc.pid} exited with {proc.returncode}, restarting")
+                    time.sleep(RESTART_DELAY)
+                    procs[i] = spawn(variant, host, port, fd, ready_w)
+            time.sleep(0.5)
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a tkdl variant as several worker processes.")
+    parser.add_argument("variant", choices=VARIANTS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "5000")))
+    parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--ready-fd", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_fd is not None:
+        return run_worker(args.variant, args.host, args.port, args.worker_fd, args.ready_fd)
+
+    # Read by shared.py in every worker at import time.
+    os.environ.setdefault("TKDL_STATE_DB", os.path.join(BASE_DIR, "tkdl-state.db"))
+    if args.variant == "tkdl_async":
+        import uvicorn
+
+        sys.path.insert(0, BASE_DIR)
+        uvicorn.run("tkdl_async:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        supervise(args.variant, args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+State shared between worker processes on one host (see serve.py).
+
+With TKDL_STATE_DB pointing at a SQLite file, the video cache index and
+in-flight downloads, the job table, the expiry index and the rate-limit
+buckets live in that file (WAL mode, so readers don't block the writer)
+instead of in each process. Without it everything stays in memory, as
+for a single `app.run()`.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+STATE_DB = os.environ.get("TKDL_STATE_DB")
+BUSY_TIMEOUT = 10
+
+_local = threading.local()
+
+
+def connect(path):
+    """This thread's connection to `path` (autocommit; use `transaction` to group writes)."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    db = connections.get(path)
+    if db is None:
+        db = connections[path] = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+@contextmanager
+def transaction(path):
+    """Write transaction on `path`; other processes' writers wait until it ends."""
+    db = connect(path)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class OwnerLock:
+    """
+    Exclusive flock on `<path>.<name>.lock`: at most one process holds it
+    and the kernel releases it when that process dies, so another can
+    take over.
+    """
+
+    def __init__(self, path, name):
+        self.path = f"{path}.{name}.lock"
+        self._file = None
+
+    def try_acquire(self):
+        import fcntl  # POSIX only, like multi-process mode itself
+
+        if self._file is not None:
+            return True
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    @property
+    def held(self):
+        return self._file is not None
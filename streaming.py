@@ -0,0 +1,201 @@
+import os
+from urllib.parse import quote
+
+from flask import Response, current_app, request
+from werkzeug.utils import send_from_directory
+from werkzeug.wsgi import FileWrapper
+
+from httppool import http_session
+from metrics import ACTIVE_STREAMS, VIDEO_BYTES
+from tracing import span, start_span
+
+# Relay upstream bytes straight to the client instead of spooling to disk.
+# Set TKDL_STREAM=0 to get the old write-then-send behaviour back.
+STREAM_DOWNLOADS = os.environ.get("TKDL_STREAM", "1") != "0"
+
+# Downloaded files never change under the same name, so let clients and
+# proxies keep them for as long as they live on disk.
+FILE_MAX_AGE = 300
+
+# Response headers we pass through from the CDN as-is.
+FORWARD_HEADERS = ("Content-Length", "Content-Range", "Last-Modified")
+
+CHUNK_SIZE = 64 * 1024
+# Big videos are moved in bigger chunks: about 1/64 of the size, up to this.
+MAX_CHUNK_SIZE = int(os.environ.get("TKDL_MAX_CHUNK", str(1024 * 1024)))
+
+# How cached files reach the client:
+#   ""            the WSGI server's file_wrapper (os.sendfile under gunicorn),
+#                 otherwise Werkzeug's reader with MAX_CHUNK_SIZE reads
+#   "x-sendfile"  empty body + X-Sendfile, sent by Apache/lighttpd
+#   "x-accel"     empty body + X-Accel-Redirect to ACCEL_PREFIX/<file>, sent by nginx
+SENDFILE_MODE = os.environ.get("TKDL_SENDFILE", "").lower()
+ACCEL_PREFIX = os.environ.get("TKDL_ACCEL_PREFIX", "/protected-downloads/")
+YTDLP_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+)
+
+
+def attachment_header(filename: str) -> str:
+    """Content-Disposition value that survives non-ASCII video titles."""
+    filename = "".join(c for c in filename if c not in '"\\\r\n') or "video.mp4"
+    try:
+        filename.encode("latin-1")
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename=\"video.mp4\"; filename*=UTF-8''{quote(filename)}"
+
+
+def chunk_size_for(length) -> int:
+    """Read/write size for a body of `length` bytes (unknown: CHUNK_SIZE)."""
+    size = min(CHUNK_SIZE, MAX_CHUNK_SIZE)
+    while length and size < MAX_CHUNK_SIZE and size * 64 < length:
+        size *= 2
+    return size
+
+
+def preallocate(f, length):
+    """Reserve `length` bytes for `f` up front so the file isn't grown write by write."""
+    if length and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, length)
+        except OSError:
+            pass  # e.g. not supported by this filesystem
+
+
+def accel_redirect(filename: str) -> str:
+    return ACCEL_PREFIX.rstrip("/") + "/" + quote(filename)
+
+
+def send_download(directory: str, filename: str):
+    """
+    Serve a finished download with Range, If-Range, ETag and
+    If-None-Match handling so players can seek and downloads can resume.
+    The bytes go out as SENDFILE_MODE says (see above).
+    """
+    # Only the headers are prepared here; the body is sent by the server.
+    with span("send_file", file=filename, mode=SENDFILE_MODE or "wsgi"):
+        # Werkzeug's own send_from_directory, so the proxy offload is decided
+        # per response: only the cache folder is mapped by the proxy, other
+        # send_file calls (e.g. on temp files) must send their bytes themselves.
+        response = send_from_directory(
+            directory, filename, request.environ,
+            as_attachment=True,
+            conditional=True,
+            etag=True,
+            max_age=FILE_MAX_AGE,
+            use_x_sendfile=SENDFILE_MODE in ("x-sendfile", "x-accel"),
+            response_class=current_app.response_class,
+        )
+        if "X-Sendfile" in response.headers and SENDFILE_MODE == "x-accel":
+            del response.headers["X-Sendfile"]
+            response.headers["X-Accel-Redirect"] = accel_redirect(filename)
+        # Werkzeug's own wrapper (no server file_wrapper) reads 8 KB at a time.
+        body = getattr(response.response, "iterable", response.response)
+        if isinstance(body, FileWrapper):
+            body.buffer_size = chunk_size_for(response.content_length)
+        return response
+
+
+def video_etag(key: str) -> str:
+    """
+    Our ETag for a video relayed from the CDN. Weak: a later resolve may
+    pick another provider or rendition, so it vouches for the video but
+    not its bytes - fine for If-None-Match, never for If-Range.
+    """
+    return f'W/"{key}"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """True if an If-None-Match / If-Range value names `etag` (or is `*`)."""
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or etag in [t[2:] for t in tags if t.startswith("W/")]
+
+
+def upstream_request_headers(etag=None, client_headers=None):
+    """
+    Range headers to forward to the CDN for the current client request
+    (or for `client_headers`, when called outside Flask).
+    If-Range goes to the CDN, which knows the bytes it is serving; one
+    naming a weak ETag (ours, see video_etag) can't vouch for a range, so
+    the whole video is asked for instead.
+    """
+    if client_headers is None:
+        client_headers = request.headers
+    headers = {}
+    byte_range = client_headers.get("Range")
+    if_range = client_headers.get("If-Range")
+    if byte_range and not (if_range and if_range.strip().startswith("W/")):
+        headers["Range"] = byte_range
+        if if_range:
+            headers["If-Range"] = if_range
+    if not etag and client_headers.get("If-None-Match"):
+        headers["If-None-Match"] = client_headers["If-None-Match"]
+    return headers
+
+
+def stream_url(video_url: str, download_name="tiktok.mp4", timeout=30, etag=None, headers=None):
+    """
+    Proxy `video_url` to the client chunk by chunk, sending `headers`
+    (e.g. the cookies a provider resolved it with) upstream.
+    Raises before any byte is sent if the upstream request fails, so callers
+    can still fall back to another provider or return a JSON error.
+
+    `etag` should be stable for the video (e.g. its ID); it is sent as a
+    weak ETag (see video_etag). With it, a matching If-None-Match is
+    answered with 304 without touching the CDN; Range and If-Range are
+    forwarded upstream and 206/416 answers are relayed.
+    """
+    if etag:
+        etag = video_etag(etag)
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status=304, headers={"ETag": etag, "Accept-Ranges": "bytes"})
+
+    send = dict(headers or {})
+    send.update(upstream_request_headers(etag))
+    with span("cdn_connect"):
+        r = http_session.get(video_url, stream=True, timeout=timeout, headers=send)
+    if r.status_code in (304, 416):
+        r.close()
+        headers = {h: r.headers[h] for h in ("ETag", "Content-Range") if h in r.headers}
+        return Response(status=r.status_code, headers=headers)
+    r.raise_for_status()
+
+    # Ends when the server has drained the body, after the view returned.
+    relay = start_span("relay", source="cdn")
+    chunk_size = chunk_size_for(int(r.headers.get("Content-Length") or 0))
+
+    def generate():
+        ACTIVE_STREAMS.inc()
+        sent = 0
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    VIDEO_BYTES.inc(len(chunk), direction="relayed", source="cdn")
+                    sent += len(chunk)
+                    yield chunk
+        finally:
+            ACTIVE_STREAMS.dec()
+            relay.set(bytes=sent)
+            relay.finish()
+            r.close()
+
+    headers = {
+        "Content-Disposition": attachment_header(download_name),
+        "Accept-Ranges": "bytes",
+    }
+    for name in FORWARD_HEADERS:
+        if r.headers.get(name):
+            headers[name] = r.headers[name]
+    if etag or r.headers.get("ETag"):
+        headers["ETag"] = etag or r.headers["ETag"]
+    return Response(
+        generate(),
+        status=r.status_code,
+        headers=headers,
+        mimetype=r.headers.get("Content-Type", "video/mp4"),
+        direct_passthrough=True,
+    )
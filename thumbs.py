@@ -0,0 +1,216 @@
+"""
+Video covers served from /thumb/<video_id> instead of hotlinking the
+provider's (slow, expiring, full-size) cover URL.
+
+A cover is fetched once, kept on disk in its own size-bounded LRU cache
+and, for the hot ones, in memory. `?w=` asks for a resized copy, which
+is cached the same way. Resizing needs Pillow; without it the original
+is served for every width. A video the providers say has no cover (or
+doesn't exist) is remembered for TKDL_THUMB_MISS_SECONDS; a failed lookup
+(providers down, circuits open) is not, it's retried. Fetches (not cache
+hits) count against the caller's rate limit, so made-up IDs can't drive
+the provider chain.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, Response, jsonify, request
+
+from canonical import video_page_url
+from httppool import http_session
+from metacache import video_id_from_url
+from health import NotFound
+from providers import forget_info, video_info
+from ratelimit import RateLimited, check_client, limited_response
+from scheduler import client_id
+from videocache import open_cache
+
+try:
+    from PIL import Image
+except ImportError:  # optional
+    Image = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+THUMB_FOLDER = os.environ.get("TKDL_THUMB_DIR", os.path.join(BASE_DIR, "static", "thumbs"))
+THUMB_BYTES = int(os.environ.get("TKDL_THUMB_BYTES", 256 * 1024 ** 2))
+THUMB_MEMORY_BYTES = int(os.environ.get("TKDL_THUMB_MEMORY_BYTES", 32 * 1024 ** 2))
+# A video's cover never changes, so browsers and proxies may keep it a week.
+THUMB_MAX_AGE = 7 * 24 * 3600
+# Requested widths are rounded up to one of these, so ?w= can't fill the cache.
+WIDTHS = (120, 240, 360, 480, 720)
+# What the preview endpoints link to.
+PREVIEW_WIDTH = int(os.environ.get("TKDL_THUMB_WIDTH", "360"))
+# How long a video without a cover is answered from memory.
+MISS_SECONDS = float(os.environ.get("TKDL_THUMB_MISS_SECONDS", "300"))
+MAX_MISSES = 10_000
+
+
+def snap_width(width):
+    """Nearest allowed width at or above `width`; None for the original."""
+    if not width or Image is None:
+        return None
+    return next((w for w in WIDTHS if w >= width), WIDTHS[-1])
+
+
+def image_type(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"
+
+
+class ThumbCache:
+    """Covers by video ID: memory LRU in front of a disk LRU (videocache.open_cache)."""
+
+    def __init__(self, folder, max_bytes=THUMB_BYTES, memory_bytes=THUMB_MEMORY_BYTES,
+                 miss_seconds=MISS_SECONDS):
+        self.disk = open_cache(folder, max_bytes)
+        self.memory_bytes = memory_bytes
+        self.miss_seconds = miss_seconds
+        self._memory = OrderedDict()  # name -> bytes
+        self._memory_total = 0
+        self._misses = OrderedDict()  # video_id -> when "no cover" expires
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.miss_hits = 0
+        self.upstream_fetches = 0
+
+    def get(self, video_id, width=None, url=None, on_fetch=None):
+        """
+        (image bytes, name) of `video_id`'s cover, resized to `width` if
+        Pillow is there. Raises NotFound if it has no cover. `on_fetch()`
+        is called before going to disk or upstream, and may raise to refuse.
+        """
+        width = snap_width(width)
+        name = f"{video_id}.w{width}.jpg" if width else f"{video_id}.img"
+        with self._lock:
+            data = self._memory.get(name)
+            if data is not None:
+                self._memory.move_to_end(name)
+                self.memory_hits += 1
+                return data, name
+            if self._misses.get(video_id, 0) > time.monotonic():
+                self.miss_hits += 1
+                raise NotFound(f"no cover for video {video_id}")
+        if on_fetch and not self.disk.get(name):
+            on_fetch()
+        if width:
+            fill = lambda tmp: self._resize(video_id, width, url, tmp)
+        else:
+            fill = lambda tmp: self._download(video_id, url, tmp)
+        try:
+            self.disk.fetch(name, fill)
+        except NotFound:
+            self._remember_miss(video_id)
+            raise
+        with open(self.disk.path(name), "rb") as f:
+            data = f.read()
+        self._remember(name, data)
+        return data, name
+
+    def _remember_miss(self, video_id):
+        with self._lock:
+            self._misses[video_id] = time.monotonic() + self.miss_seconds
+            self._misses.move_to_end(video_id)
+            while len(self._misses) > MAX_MISSES:
+                self._misses.popitem(last=False)
+
+    def _remember(self, name, data):
+        if len(data) > self.memory_bytes // 4:
+            return
+        with self._lock:
+            if name in self._memory:
+                return
+            self._memory[name] = data
+            self._memory_total += len(data)
+            while self._memory_total > self.memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_total -= len(old)
+
+    def _download(self, video_id, url, filepath):
+        url = url or video_page_url(video_id)
+        for attempt in range(2):
+            outcomes = []
+            info = video_info(url, outcomes=outcomes)
+            if not info:
+                if outcomes and all(outcome == "not_found" for outcome in outcomes):
+                    raise NotFound(f"no video {video_id}")
+                raise RuntimeError(f"could not resolve video {video_id} ({', '.join(outcomes) or 'no provider'})")
+            cover = info.get("thumb_url")
+            if not cover:
+                raise NotFound(f"no cover for video {video_id}")
+            r = http_session.get(cover, timeout=10)
+            self.upstream_fetches += 1
+            if r.status_code in (403, 404, 410) and attempt == 0:
+                forget_info(url)  # signed cover link expired; resolve again
+                continue
+            if r.status_code in (403, 404, 410):
+                raise NotFound(f"cover of video {video_id} is gone ({r.status_code})")
+            r.raise_for_status()
+            with open(filepath, "wb") as f:
+                f.write(r.content)
+            return True
+
+    def _resize(self, video_id, width, url, filepath):
+        _, original = self.get(video_id, url=url)
+        with Image.open(self.disk.path(original)) as image:
+            image = image.convert("RGB")
+            if image.width > width:
+                image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            image.save(filepath, "JPEG", quality=85, optimize=True)
+        return True
+
+    def stats(self):
+        with self._lock:
+            memory = {"memory_items": len(self._memory), "memory_bytes": self._memory_total,
+                      "memory_hits": self.memory_hits, "misses_remembered": len(self._misses),
+                      "miss_hits": self.miss_hits}
+        return dict(self.disk.stats(), upstream_fetches=self.upstream_fetches,
+                    resize=Image is not None, **memory)
+
+
+thumb_cache = ThumbCache(THUMB_FOLDER)
+
+
+def thumb_link(url, info=None, width=PREVIEW_WIDTH):
+    """Our /thumb link for `url`'s cover, or the provider's own link if there's no video ID."""
+    video_id = video_id_from_url(url)
+    if not video_id:
+        return (info or {}).get("thumb_url")
+    return f"/thumb/{video_id}?w={width}" if width else f"/thumb/{video_id}"
+
+
+def thumb_headers(name):
+    return {
+        "Cache-Control": f"public, max-age={THUMB_MAX_AGE}, immutable",
+        "ETag": f'"{name}"',
+    }
+
+
+def thumbs_blueprint(cache=thumb_cache):
+    """GET /thumb/<video_id>[?w=width] -> the cover image."""
+    bp = Blueprint("thumbs", __name__)
+
+    @bp.route("/thumb/<video_id>")
+    def thumb(video_id):
+        if not video_id.isdigit():
+            return jsonify({"error": "Unknown video"}), 404
+        try:
+            data, name = cache.get(video_id, request.args.get("w", type=int),
+                                   on_fetch=lambda: check_client(client_id(request)))
+        except RateLimited as e:
+            return limited_response(e)
+        except Exception as e:
+            print(f"[Thumb] {video_id}: {e}")
+            return jsonify({"error": "Cover not available"}), 404
+        response = Response(data, mimetype=image_type(data), headers=thumb_headers(name))
+        return response.make_conditional(request)
+
+    return bp
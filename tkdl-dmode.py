@@ -1,58 +1,32 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import requests
+from flask import render_template, request, jsonify, send_file, redirect, url_for
 import os
 import tempfile
-from yt_dlp import YoutubeDL
-
-app = Flask(__name__)
-
-# Unified extractor
-def extract_video_info(url):
-    try:
-        # Try TikWM
-        api_url = "https://www.tikwm.com/api/"
-        res = requests.post(api_url, data={"url": url}, timeout=10)
-        data = res.json()
-        if data.get("code") == 0:
-            return {
-                "success": True,
-                "url": data["data"]["play"],
-                "thumbnail": data["data"]["cover"],
-                "title": data["data"]["title"] or "video"
-            }
-    except Exception:
-        pass
-
-    try:
-        # Try SnapTik
-        api_url = "https://api.snaptik.app/api/v1/video/details"
-        res = requests.post(api_url, data={"url": url}, timeout=10)
-        data = res.json()
-        if data.get("status") == "ok":
-            return {
-                "success": True,
-                "url": data["video"]["play"],
-                "thumbnail": data["video"]["thumbnail"],
-                "title": data["video"].get("title", "video")
-            }
-    except Exception:
-        pass
-
-    try:
-        # Fallback: yt-dlp
-        ydl_opts = {"quiet": True, "format": "mp4"}
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return {
-                "success": True,
-                "url": info["url"],
-                "thumbnail": info.get("thumbnail"),
-                "title": info.get("title", "video")
-            }
-    except Exception as e:
-        return {"success": False, "error": str(e)}
-
-    return {"success": False, "error": "No extractor worked."}
+from metacache import video_id_from_url
+from streaming import STREAM_DOWNLOADS, stream_url
+from providers import sanitize_url, video_info, fetch_video, forget_info
+from scheduler import download_scheduler, client_id, busy_response, QueueFull
+from webapp import create_app, prefetched_download
+from previews import Superseded, preview_info, preview_session, superseded_response
+from expiry import file_expiry
+from thumbs import thumb_link
+
+# Video cache, /downloads, /cache/stats, /jobs and /batch (see webapp.py)
+app = create_app(__name__)
+
+
+# Unified extractor, shared by /preview (coalesced, see previews.py)
+# and /download through the cache
+def extract_video_info(url, preview=False):
+    info = preview_info(url, preview_session(request)) if preview else video_info(url)
+    if not info:
+        return {"success": False, "error": "No extractor worked."}
+    return {
+        "success": True,
+        "url": info["video_url"],
+        "thumbnail": thumb_link(url, info),
+        "title": info.get("title") or "video",
+        "headers": info.get("headers"),
+    }
 
 
 @app.route("/")
@@ -63,42 +37,61 @@ def index():
 @app.route("/preview", methods=["POST"])
 def preview():
     data = request.get_json()
-    url = data.get("url", "").strip()
-    if not url.startswith("http"):
+    url = sanitize_url(data.get("url", ""))
+    if not url:
         return jsonify({"success": False, "error": "Invalid URL"})
-    info = extract_video_info(url)
+    try:
+        info = extract_video_info(url, preview=True)
+    except Superseded as e:
+        return superseded_response(e)
+    info.pop("headers", None)
     return jsonify(info)
 
 
 @app.route("/download", methods=["POST"])
 def download():
     data = request.get_json()
-    url = data.get("url", "").strip()
-    if not url.startswith("http"):
+    url = sanitize_url(data.get("url", ""))
+    if not url:
         return jsonify({"success": False, "error": "Invalid URL"})
 
     info = extract_video_info(url)
     if not info.get("success"):
         return jsonify(info)
 
+    # Already on disk if /preview fetched it in the background (see prefetch.py)
+    filename = prefetched_download(app, url)
+    if filename:
+        return redirect(url_for("serve_file", filename=filename))
+
+    if STREAM_DOWNLOADS:
+        try:
+            return stream_url(info["url"], download_name=f"{info['title']}.mp4",
+                              etag=video_id_from_url(url), headers=info["headers"])
+        except Exception as e:
+            forget_info(url)
+            return jsonify({"success": False, "error": str(e)})
+
+    # Save file temporarily; deleted once it has been sent
+    tmp_fd, tmp_path = tempfile.mkstemp(suffix=".mp4")
+    os.close(tmp_fd)
+    file_expiry.acquire(tmp_path)
+    file_expiry.schedule(tmp_path, 0)
     try:
-        # Save file temporarily
-        tmp_fd, tmp_path = tempfile.mkstemp(suffix=".mp4")
-        os.close(tmp_fd)
-
-        r = requests.get(info["url"], stream=True, timeout=30)
-        with open(tmp_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        download_scheduler.run(client_id(request), fetch_video, url, tmp_path)
 
-        return send_file(
+        response = send_file(
             tmp_path,
             as_attachment=True,
             download_name=f"{info['title']}.mp4"
         )
+    except QueueFull as e:
+        file_expiry.release(tmp_path)
+        return busy_response(e)
     except Exception as e:
+        file_expiry.release(tmp_path)
         return jsonify({"success": False, "error": str(e)})
+    return file_expiry.release_with(response, tmp_path)
 
 
 if __name__ == "__main__":
@@ -1,43 +1,22 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import requests
-import uuid
-import os
-import threading
-import time
+from flask import render_template, request, jsonify, url_for
+from metacache import video_id_from_url
+from streaming import STREAM_DOWNLOADS, stream_url
+from providers import sanitize_url, video_info, forget_info
+from scheduler import client_id, busy_response, QueueFull
+from webapp import create_app, cached_download, prefetched_download
+from previews import Superseded, preview_info, preview_session, superseded_response
+from thumbs import thumb_link
 
-app = Flask(__name__)
-DOWNLOAD_FOLDER = os.path.join(app.root_path, "static", "downloads")
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+# Video cache, /downloads, /cache/stats, /jobs and /batch (see webapp.py)
+app = create_app(__name__)
 
 
-def extract_video_info(url):
-    """Unified video info extractor (using tikwm API)."""
-    api_url = "https://www.tikwm.com/api/"
-    try:
-        res = requests.post(api_url, data={"url": url}, timeout=15)
-        data = res.json()
-        if data.get("code") == 0:
-            return {
-                "video_url": data["data"]["play"],
-                "thumb_url": data["data"]["cover"],
-            }
-    except Exception as e:
-        print(f"Error extracting video info: {e}")
-    return None
-
-
-def schedule_file_deletion(filepath, delay=180):
-    """Delete a file after `delay` seconds."""
-    def delete_later():
-        time.sleep(delay)
-        try:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                print(f"[CLEANUP] Deleted file: {filepath}")
-        except Exception as e:
-            print(f"[CLEANUP ERROR] {e}")
-
-    threading.Thread(target=delete_later, daemon=True).start()
+def extract_video_info(url, preview=False):
+    """Unified video info extractor (cached, see providers.py); coalesced for previews (see previews.py)."""
+    url = sanitize_url(url)
+    if not url:
+        return None
+    return preview_info(url, preview_session(request)) if preview else video_info(url)
 
 
 @app.route("/")
@@ -48,9 +27,12 @@ def index():
 @app.route("/preview", methods=["POST"])
 def preview():
     url = request.json.get("url")
-    info = extract_video_info(url)
+    try:
+        info = extract_video_info(url, preview=True)
+    except Superseded as e:
+        return superseded_response(e)
     if info:
-        return jsonify(info)
+        return jsonify({"video_url": info["video_url"], "thumb_url": thumb_link(url, info)})
     return jsonify({"error": "Could not load preview."})
 
 
@@ -61,21 +43,40 @@ def download():
     if not info:
         return jsonify({"error": "Download failed."}), 400
 
-    filename = f"{uuid.uuid4()}.mp4"
-    filepath = os.path.join(DOWNLOAD_FOLDER, filename)
+    # Already on disk if /preview fetched it in the background (see prefetch.py)
+    filename = prefetched_download(app, sanitize_url(url))
+    if filename:
+        return jsonify({"download_url": url_for("serve_file", filename=filename)})
+
+    if STREAM_DOWNLOADS:
+        # The browser follows this link and gets the bytes relayed from the
+        # CDN; metadata is already cached so /stream doesn't resolve again.
+        return jsonify({"download_url": url_for("stream", url=url)})
 
+    # One file per video in the cache; only the actual fetch is queued on
+    # the scheduler.
     try:
-        r = requests.get(info["video_url"], stream=True, timeout=30)
-        with open(filepath, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+        filename = cached_download(app, sanitize_url(url), client=client_id(request))
+        return jsonify({"download_url": url_for("serve_file", filename=filename)})
+    except QueueFull as e:
+        return busy_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        # Schedule file deletion after 3 minutes
-        schedule_file_deletion(filepath, delay=180)
 
-        return jsonify({"download_url": f"/static/downloads/{filename}"})
+@app.route("/stream")
+def stream():
+    url = request.args.get("url", "")
+    info = extract_video_info(url)
+    if not info:
+        return jsonify({"error": "Download failed."}), 400
+    try:
+        return stream_url(info["video_url"], download_name="tiktok.mp4",
+                          etag=video_id_from_url(url), headers=info.get("headers"))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        # Probably an expired signed link; resolve again next time.
+        forget_info(sanitize_url(url))
+        return jsonify({"error": str(e)}), 502
 
 
 if __name__ == "__main__":
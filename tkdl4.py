@@ -1,13 +1,21 @@
-from flask import Flask, request, send_from_directory, jsonify, send_file, render_template
-import os, uuid, threading, time, tempfile, requests, yt_dlp, shutil
-
-app = Flask(__name__)
-
-DOWNLOAD_FOLDER = os.path.join(app.root_path, "static", "downloads")
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+from flask import request, send_from_directory, jsonify, send_file, render_template, redirect, url_for
+import os, tempfile
+from providers import sanitize_url, fetch_video
+from scheduler import download_scheduler, client_id, busy_response, QueueFull
+from webapp import create_app, prefetched_download
+from previews import Superseded, preview_info, preview_session, superseded_response
+from expiry import file_expiry
+from thumbs import thumb_link
+
+# Video cache, /downloads, /cache/stats, /jobs and /batch (see webapp.py)
+app = create_app(__name__)
+DOWNLOAD_FOLDER = app.config["DOWNLOAD_FOLDER"]
 
 TEMP_BASE = os.path.join(tempfile.gettempdir(), "tkdl_temp")
 os.makedirs(TEMP_BASE, exist_ok=True)
+TEMP_TTL = 300
+# Temp dirs left behind by a previous run
+file_expiry.adopt(TEMP_BASE, TEMP_TTL, dirs=True)
 
 
 @app.route("/")
@@ -18,56 +26,25 @@ def home():
 # Preview endpoint
 @app.route("/preview", methods=["POST"])
 def preview():
-    url = request.form.get("url")
+    url = sanitize_url(request.form.get("url"))
     if not url:
         return jsonify({"error": "Missing TikTok URL"}), 400
 
     try:
-        # 1. Try TikWM API
-        try:
-            resp = requests.post("https://www.tikwm.com/api/", data={"url": url}, timeout=10)
-            data = resp.json()
-            if data.get("data"):
-                return jsonify({
-                    "status": "ok",
-                    "thumbnail": data["data"]["cover"],
-                    "author": data["data"]["author"],
-                    "desc": data["data"]["title"],
-                    "video": data["data"]["play"],
-                })
-        except Exception:
-            pass
-
-        # 2. Try SnapTik API
-        try:
-            resp = requests.get(f"https://ssstik.io/abc?url={url}", timeout=10)
-            if resp.ok:
-                return jsonify({
-                    "status": "ok",
-                    "thumbnail": "",
-                    "author": "",
-                    "desc": "",
-                    "video": url,
-                })
-        except Exception:
-            pass
-
-        # 3. Fallback to yt-dlp
-        try:
-            ydl_opts = {"quiet": True, "skip_download": True}
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                return jsonify({
-                    "status": "ok",
-                    "thumbnail": info.get("thumbnail", ""),
-                    "author": info.get("uploader", ""),
-                    "desc": info.get("title", ""),
-                    "video": info.get("url", ""),
-                })
-        except Exception:
-            pass
-
+        # TikWM, SnapTik and yt-dlp, first to answer wins (see providers.py);
+        # metadata only, never the video itself (see previews.py)
+        info = preview_info(url, preview_session(request))
+        if info:
+            return jsonify({
+                "status": "ok",
+                "thumbnail": thumb_link(url, info) or "",
+                "author": info.get("author") or "",
+                "desc": info.get("title") or "",
+                "video": info["video_url"],
+            })
         return jsonify({"error": "Could not fetch preview"}), 500
+    except Superseded as e:
+        return superseded_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -75,60 +52,41 @@ def preview():
 # Download endpoint — returns actual file
 @app.route("/download", methods=["POST"])
 def download():
-    url = request.form.get("url")
+    url = sanitize_url(request.form.get("url"))
     if not url:
         return jsonify({"error": "No URL provided"}), 400
 
+    # Already on disk if /preview fetched it in the background (see prefetch.py)
+    filename = prefetched_download(app, url)
+    if filename:
+        return redirect(url_for("serve_file", filename=filename))
+
+    # Unique temp folder, removed after TEMP_TTL but never mid-send
+    tmpdir = tempfile.mkdtemp(dir=TEMP_BASE)
+    file_expiry.schedule(tmpdir, TEMP_TTL)
+    file_expiry.acquire(tmpdir)
     try:
-        # Create unique temp folder
-        tmpdir = tempfile.mkdtemp(dir=TEMP_BASE)
         filepath = os.path.join(tmpdir, "tiktok.mp4")
 
-        ydl_opts = {
-            "outtmpl": filepath,
-            "format": "mp4/best"
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        # Bounded worker pool; 429 + Retry-After when it's full
+        download_scheduler.run(client_id(request), fetch_video, url, filepath)
 
         # Return file for browser save
-        return send_file(
+        response = send_file(
             filepath,
             as_attachment=True,
             download_name="tiktok.mp4",
             mimetype="video/mp4"
         )
 
+    except QueueFull as e:
+        file_expiry.release(tmpdir)
+        return busy_response(e)
     except Exception as e:
-        return jsonify({"error": f"yt-dlp failed: {str(e)}"}), 500
-
-
-@app.route("/downloads/<filename>")
-def serve_file(filename):
-    return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True)
-
-
-# Background cleanup for both static downloads and temp dirs
-def cleanup_loop():
-    while True:
-        now = time.time()
-
-        # clean static downloads
-        for f in os.listdir(DOWNLOAD_FOLDER):
-            path = os.path.join(DOWNLOAD_FOLDER, f)
-            if os.path.isfile(path) and now - os.path.getmtime(path) > 300:
-                os.remove(path)
-
-        # clean temp download dirs
-        for d in os.listdir(TEMP_BASE):
-            path = os.path.join(TEMP_BASE, d)
-            if os.path.isdir(path) and now - os.path.getmtime(path) > 300:
-                shutil.rmtree(path, ignore_errors=True)
-
-        time.sleep(300)
+        file_expiry.release(tmpdir)
+        return jsonify({"error": f"download failed: {str(e)}"}), 500
+    return file_expiry.release_with(response, tmpdir)
 
-threading.Thread(target=cleanup_loop, daemon=True).start()
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -1,71 +1,35 @@
-import os
-import uuid
-import subprocess
-import requests
-from flask import Flask, request, render_template, send_from_directory, jsonify, url_for
-
-app = Flask(__name__)
-
-# Folder for temporary downloads
-DOWNLOAD_FOLDER = os.path.join(app.root_path, "downloads")
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-
-
-def sanitize_url(url: str) -> str:
-    """Basic cleanup to avoid malformed TikTok links"""
-    if not url:
-        return ""
-    url = url.strip()
-    if "tiktok.com" not in url:
-        return ""
-    return url.split("?")[0]  # remove tracking params
-
-
-def download_with_tikwm(url: str):
-    """Try Tikwm API"""
-    try:
-        api_url = f"https://www.tikwm.com/api/?url={url}"
-        resp = requests.get(api_url, timeout=10).json()
-        if resp.get("data"):
-            return {
-                "video_url": resp["data"].get("play"),
-                "thumbnail_url": resp["data"].get("cover")
-            }
-    except Exception:
-        return None
-    return None
-
-
-def download_with_snaptik(url: str):
-    """Try SnapTik API"""
-    try:
-        api_url = f"https://api.snaptik.app/api/v1/fetch?url={url}"
-        resp = requests.get(api_url, timeout=10).json()
-        if resp.get("video"):
-            return {
-                "video_url": resp.get("video"),
-                "thumbnail_url": resp.get("cover")
-            }
-    except Exception:
-        return None
-    return None
-
-
-def download_with_ytdlp(url: str):
-    """Fallback to yt-dlp"""
+from flask import request, render_template, jsonify, url_for
+from metacache import video_id_from_url
+from providers import NEEDS_HEADERS, sanitize_url, video_info, get_provider, forget_info
+from scheduler import client_id, busy_response, QueueFull
+from streaming import stream_url
+from webapp import create_app, cached_download
+from previews import Superseded, preview_info, preview_session, superseded_response
+from thumbs import thumb_link
+
+# Video cache in ./downloads, /downloads, /cache/stats, /jobs and /batch (see webapp.py)
+app = create_app(__name__, download_folder="downloads")
+
+
+def resolve_video(url):
+    """
+    {"video_url", "thumbnail_url"} for `url`: the CDN link when a provider
+    gives one the browser can open directly, else our cached copy of the
+    video (downloaded on the scheduler; may raise QueueFull).
+    """
+    info = video_info(url)
+    if info and NEEDS_HEADERS not in get_provider(info["provider"]).capabilities:
+        return {"video_url": info["video_url"], "thumbnail_url": thumb_link(url, info)}
     try:
-        filename = f"{uuid.uuid4()}.mp4"
-        filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-
-        cmd = ["yt-dlp", "-o", filepath, url]
-        subprocess.run(cmd, check=True)
-
-        return {
-            "video_url": url_for("serve_file", filename=filename),
-            "thumbnail_url": None
-        }
+        filename = cached_download(app, url, client=client_id(request))
+    except QueueFull:
+        raise
     except Exception:
         return None
+    return {
+        "video_url": url_for("serve_file", filename=filename),
+        "thumbnail_url": thumb_link(url, info) if info else None,
+    }
 
 
 @app.route("/")
@@ -79,22 +43,34 @@ def preview():
     if not url:
         return jsonify({"error": "Invalid or missing TikTok URL"}), 400
 
-    # Try Tikwm
-    result = download_with_tikwm(url)
-    if result:
-        return jsonify(result)
+    # Metadata only: a link the browser can't open by itself is played
+    # through /stream rather than downloaded first (see previews.py).
+    try:
+        info = preview_info(url, preview_session(request))
+    except Superseded as e:
+        return superseded_response(e)
+    if info:
+        video_url = info["video_url"]
+        if NEEDS_HEADERS in get_provider(info["provider"]).capabilities:
+            video_url = url_for("stream", url=url)
+        return jsonify({"video_url": video_url, "thumbnail_url": thumb_link(url, info)})
 
-    # Fallback: SnapTik
-    result = download_with_snaptik(url)
-    if result:
-        return jsonify(result)
+    return jsonify({"error": "Could not extract video"}), 500
 
-    # Last resort: yt-dlp
-    result = download_with_ytdlp(url)
-    if result:
-        return jsonify(result)
 
-    return jsonify({"error": "Could not extract video"}), 500
+@app.route("/stream")
+def stream():
+    url = sanitize_url(request.args.get("url", ""))
+    info = video_info(url) if url else None
+    if not info:
+        return jsonify({"error": "Could not extract video"}), 400
+    try:
+        return stream_url(info["video_url"], download_name="tiktok.mp4",
+                          etag=video_id_from_url(url), headers=info.get("headers"))
+    except Exception as e:
+        # Probably an expired signed link; resolve again next time.
+        forget_info(url)
+        return jsonify({"error": str(e)}), 502
 
 
 @app.route("/download", methods=["POST"])
@@ -103,26 +79,15 @@ def download():
     if not url:
         return "Invalid URL", 400
 
-    # Reuse same order
-    result = download_with_tikwm(url)
-    if result and result["video_url"]:
-        return f"<meta http-equiv='refresh' content='0;url={result['video_url']}'>"
-
-    result = download_with_snaptik(url)
-    if result and result["video_url"]:
-        return f"<meta http-equiv='refresh' content='0;url={result['video_url']}'>"
-
-    result = download_with_ytdlp(url)
+    try:
+        result = resolve_video(url)
+    except QueueFull as e:
+        return busy_response(e)
     if result and result["video_url"]:
         return f"<meta http-equiv='refresh' content='0;url={result['video_url']}'>"
 
     return "Download failed", 500
 
 
-@app.route("/downloads/<path:filename>")
-def serve_file(filename):
-    return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True)
-
-
 if __name__ == "__main__":
     app.run(debug=True)
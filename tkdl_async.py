@@ -0,0 +1,469 @@
+"""
+asyncio/ASGI variant of the downloader: same page and routes as tkdl.py
+(`/`, `/preview`, `/download`, `/downloads/<filename>`), but provider
+calls use an async HTTP client and downloads are relayed as async
+streams, so an in-flight download costs a socket and a small buffer
+instead of a whole thread.
+
+    uvicorn tkdl_async:app --port 5000        (or: python tkdl_async.py)
+"""
+import asyncio
+import contextlib
+import os
+import time
+from urllib.parse import quote
+
+import httpx
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from health import PROBE, is_failure, provider_health, health_stats
+from metrics import (
+    ACTIVE_STREAMS, CONTENT_TYPE, HTTP_REQUESTS, HTTP_SECONDS, PROVIDER_SECONDS, VIDEO_BYTES,
+    GaugeFunc, registry, stats_gauge,
+)
+from metacache import metadata_cache, cache_key
+from ratelimit import RateLimited, check_client, upstream_budget, stats as ratelimit_stats
+from scheduler import forwarded_client
+from resolvers import FAILURE_PENALTY
+from videocache import cache_name
+from streaming import (
+    FILE_MAX_AGE, FORWARD_HEADERS, SENDFILE_MODE, YTDLP_USER_AGENT,
+    accel_redirect, attachment_header, chunk_size_for, etag_matches, video_etag,
+    upstream_request_headers,
+)
+from ytdlp_worker import ytdlp_pool
+from tracing import begin_request, current_request_id, end_request, span, start_span
+from canonical import is_short_link, short_links
+from providers import get_provider, info_engine, info_key, sanitize_url
+from previews import Superseded, preview_session
+from thumbs import image_type, thumb_cache, thumb_headers, thumb_link
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DOWNLOAD_FOLDER = os.path.join(BASE_DIR, "static", "downloads")
+os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+
+# Upstream connections kept by the async client (all hosts together).
+MAX_CONNECTIONS = int(os.environ.get("TKDL_ASYNC_CONNECTIONS", "1000"))
+
+client = httpx.AsyncClient(
+    timeout=httpx.Timeout(30, connect=5),
+    limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=100),
+    headers={"User-Agent": YTDLP_USER_AGENT},
+    follow_redirects=True,
+)
+
+
+async def run_provider(provider, url, probe=False):
+    with span("provider", provider=provider.name) as trace:
+        health = provider_health(provider.name)
+        try:
+            # The buckets may be in SQLite (BEGIN IMMEDIATE): not on the event loop.
+            wait = await run_in_threadpool(upstream_budget.reserve, provider.name)
+            if wait:
+                await asyncio.sleep(wait)
+        except RateLimited:
+            health.release(probe)
+            trace.set(outcome="throttled")
+            return None
+        except asyncio.CancelledError:
+            # Cancelled before calling out: hand back the half-open probe.
+            health.release(probe)
+            trace.set(outcome="cancelled")
+            raise
+        started = time.monotonic()
+        try:
+            info = await provider.aresolve(url, client)
+        except asyncio.CancelledError:
+            health.release(probe)
+            # Another provider won: this one was at least this slow (as in resolvers.py).
+            info_engine.record(provider.name, time.monotonic() - started)
+            PROVIDER_SECONDS.observe(time.monotonic() - started, provider=provider.name, outcome="cancelled")
+            trace.set(outcome="cancelled")
+            raise
+        except Exception as e:
+            failed = is_failure(e)
+            if failed:
+                print(f"[{provider.name} error] {e}")
+            info = None
+        else:
+            failed = not info
+        elapsed = time.monotonic() - started
+        # Latency feeds the shared engine's ordering, like the sync apps' calls.
+        info_engine.record(provider.name, max(elapsed, FAILURE_PENALTY) if failed else elapsed)
+        # A "no such video" answer (NotFound) leaves the provider healthy.
+        health.record(not failed, elapsed, probe)
+        outcome = "ok" if info else "error" if failed else "not_found"
+        PROVIDER_SECONDS.observe(elapsed, provider=provider.name, outcome=outcome)
+        trace.set(outcome=outcome)
+        return info
+
+
+async def resolve_info(url):
+    """
+    Async counterpart of ResolverEngine.resolve over the same providers,
+    in the order and mode of providers.info_engine (fastest observed
+    first): the next one also starts when the previous fails or (in
+    hedged mode) takes longer than the hedge delay; the first answer wins
+    and the rest are cancelled. Providers with an open circuit are skipped.
+    """
+    delay = {"race": 0, "sequential": None}.get(info_engine.mode, info_engine.hedge_delay)
+    waiting = [get_provider(name) for name, _ in info_engine.ordered()]
+    running = set()
+    try:
+        while True:
+            while waiting:
+                provider = waiting.pop(0)
+                allowed = provider_health(provider.name).allow()
+                if allowed:
+                    running.add(asyncio.create_task(run_provider(provider, url, allowed == PROBE)))
+                    if delay != 0:
+                        break
+            if not running:
+                return None
+            done, running = await asyncio.wait(
+                running,
+                timeout=delay if waiting else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.result():
+                    return task.result()
+    finally:
+        for task in running:
+            task.cancel()
+
+
+_inflight = {}
+_waiting = {}  # info key -> callers awaiting its resolution
+_previews = {}  # preview session -> Event set when a newer preview supersedes its current one
+
+
+async def traced_resolve(url):
+    with span("resolve"):
+        return await resolve_info(url)
+
+
+def _forget_resolution(key, task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+
+
+async def video_info(url):
+    """
+    Cached metadata for `url`; concurrent misses share one resolution,
+    which is cancelled if every caller gives up on it.
+    """
+    key = info_key(url)
+    info = metadata_cache.get(key)
+    if info is not None:
+        return info
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.create_task(traced_resolve(url))
+        task.add_done_callback(lambda t: _forget_resolution(key, t))
+    _waiting[key] = _waiting.get(key, 0) + 1
+    try:
+        info = await asyncio.shield(task)
+    finally:
+        _waiting[key] -= 1
+        if not _waiting[key]:
+            del _waiting[key]
+            if not task.done():
+                _forget_resolution(key, task)
+                task.cancel()
+    if info:
+        metadata_cache.set(key, info)
+    return info
+
+
+async def preview_info(url, session=None):
+    """video_info for a /preview from page `session`; raises Superseded if it sends a newer one first (see previews.py)."""
+    if not session:
+        return await video_info(url)  # coalesced there; nothing to supersede
+    superseded = asyncio.Event()
+    previous = _previews.get(session)
+    if previous is not None:
+        previous.set()
+    _previews[session] = superseded
+    lookup = asyncio.ensure_future(video_info(url))
+    stop = asyncio.ensure_future(superseded.wait())
+    try:
+        done, _ = await asyncio.wait((lookup, stop), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop.cancel()
+        if not lookup.done():
+            lookup.cancel()
+        if _previews.get(session) is superseded:
+            del _previews[session]
+    if lookup not in done:
+        raise Superseded()
+    return lookup.result()
+
+
+def client_ip(request):
+    """Like scheduler.client_id: X-Forwarded-For only from TKDL_TRUSTED_PROXIES."""
+    return forwarded_client(request.headers.get("x-forwarded-for"),
+                            request.client.host if request.client else None)
+
+
+async def sanitize(url):
+    """sanitize_url off the event loop when it may block."""
+    url = (url or "").strip()
+    if url and is_short_link(url):
+        # First sighting of a short link means a blocking redirect lookup.
+        return await run_in_threadpool(sanitize_url, url)
+    return sanitize_url(url)
+
+
+async def request_url(request):
+    await run_in_threadpool(check_client, client_ip(request))  # raises RateLimited -> 429
+    if request.headers.get("content-type", "").startswith("application/json"):
+        payload = await request.json()
+    else:
+        payload = await request.form()
+    return await sanitize(payload.get("url"))
+
+
+# -------- Routes -------- #
+
+async def index(request):
+    return FileResponse(os.path.join(BASE_DIR, "templates", "index.html"))
+
+
+async def preview(request):
+    url = await request_url(request)
+    info = await preview_info(url, preview_session(request)) if url else None
+    if not info:
+        return JSONResponse({"error": "Could not load preview."})
+    data = {k: v for k, v in info.items() if k != "headers"}
+    data["thumb_url"] = thumb_link(url, info)
+    return JSONResponse(data)
+
+
+async def download(request):
+    url = await request_url(request)
+    info = await video_info(url) if url else None
+    if not info:
+        return JSONResponse({"error": "Download failed."}, status_code=400)
+    # Metadata is cached now, so the link below doesn't resolve again. The
+    # name matches the Flask apps' video cache, so a copy on disk is reused.
+    return JSONResponse({"download_url": f"/downloads/{cache_name(url)}?url={quote(url, safe='')}"})
+
+
+async def serve_file(request):
+    filename = os.path.basename(request.path_params["filename"])
+    path = os.path.join(DOWNLOAD_FOLDER, filename)
+    if os.path.isfile(path):
+        # Already in the shared video cache (written by the Flask apps).
+        headers = {"Cache-Control": f"public, max-age={FILE_MAX_AGE}"}
+        if SENDFILE_MODE in ("x-sendfile", "x-accel"):
+            # The fronting proxy sends the bytes (and handles Range).
+            headers["Content-Disposition"] = attachment_header(filename)
+            if SENDFILE_MODE == "x-accel":
+                headers["X-Accel-Redirect"] = accel_redirect(filename)
+            else:
+                headers["X-Sendfile"] = path
+            return Response(headers=headers, media_type="video/mp4")
+        response = FileResponse(path, filename=filename, headers=headers)
+        # Zero-copy when the server offers the pathsend extension; big reads otherwise.
+        response.chunk_size = chunk_size_for(os.path.getsize(path))
+        return response
+
+    # Not on disk: resolved and relayed from the CDN, so it counts like a POST.
+    await run_in_threadpool(check_client, client_ip(request))
+    video_id = filename.rsplit(".", 1)[0]
+    url = await sanitize(request.query_params.get("url"))
+    if url:
+        info = await video_info(url)
+    else:
+        info = metadata_cache.get(info_key(video_id))
+    if not info:
+        return JSONResponse({"error": "Unknown video"}, status_code=404)
+    return await stream_video(request, info, filename, cache_key(url) if url else video_id)
+
+
+async def stream_video(request, info, download_name, key):
+    """Async version of streaming.stream_url: relay the CDN response chunk by chunk."""
+    etag = video_etag(key)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Accept-Ranges": "bytes"})
+
+    headers = dict(info.get("headers") or {})
+    headers.update(upstream_request_headers(etag, request.headers))
+    try:
+        with span("cdn_connect"):
+            upstream = await client.send(client.build_request("GET", info["video_url"], headers=headers), stream=True)
+    except httpx.HTTPError as e:
+        return JSONResponse({"error": str(e)}, status_code=502)
+    if upstream.status_code in (304, 416):
+        await upstream.aclose()
+        passed = {h: upstream.headers[h] for h in ("ETag", "Content-Range") if h in upstream.headers}
+        return Response(status_code=upstream.status_code, headers=passed)
+    if upstream.status_code >= 400:
+        await upstream.aclose()
+        # Most likely an expired signed link; resolve afresh next time.
+        metadata_cache.discard(info_key(key))
+        return JSONResponse({"error": f"upstream returned {upstream.status_code}"}, status_code=502)
+
+    relay_span = start_span("relay", source="cdn")
+    chunk_size = chunk_size_for(int(upstream.headers.get("Content-Length") or 0))
+
+    async def relay():
+        ACTIVE_STREAMS.inc()
+        sent = 0
+        try:
+            async for chunk in upstream.aiter_raw(chunk_size):
+                VIDEO_BYTES.inc(len(chunk), direction="relayed", source="cdn")
+                sent += len(chunk)
+                yield chunk
+        finally:
+            ACTIVE_STREAMS.dec()
+            relay_span.set(bytes=sent)
+            relay_span.finish()
+            await upstream.aclose()
+
+    out = {
+        "Content-Disposition": attachment_header(download_name),
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+    for name in FORWARD_HEADERS:
+        if upstream.headers.get(name):
+            out[name] = upstream.headers[name]
+    return StreamingResponse(relay(), status_code=upstream.status_code, headers=out,
+                             media_type=upstream.headers.get("Content-Type", "video/mp4"))
+
+
+async def thumb(request):
+    video_id = request.path_params["video_id"]
+    width = request.query_params.get("w", "")
+    if not video_id.isdigit():
+        return JSONResponse({"error": "Unknown video"}, status_code=404)
+    try:
+        # Blocking disk/HTTP work; the shared cache is thread-based.
+        data, name = await run_in_threadpool(thumb_cache.get, video_id, int(width) if width.isdigit() else None,
+                                             on_fetch=lambda: check_client(client_ip(request)))
+    except RateLimited:
+        raise
+    except Exception as e:
+        print(f"[Thumb] {video_id}: {e}")
+        return JSONResponse({"error": "Cover not available"}, status_code=404)
+    headers = thumb_headers(name)
+    if etag_matches(request.headers.get("If-None-Match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(data, headers=headers, media_type=image_type(data))
+
+
+async def cache_stats(request):
+    return JSONResponse({
+        "metadata": metadata_cache.stats(),
+        "health": health_stats(),
+        "resolvers": {"metadata": info_engine.stats()},
+        "yt-dlp": ytdlp_pool.stats(),
+        "inflight": len(_inflight),
+        "previews": len(_previews),
+        "thumbs": thumb_cache.stats(),
+        "short_links": short_links.stats(),
+        "rate_limits": ratelimit_stats(),
+    })
+
+
+async def metrics(request):
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
+class MetricsMiddleware:
+    """Count and time requests by route (until the response starts), like metrics.instrument_flask."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                # The router has filled in the endpoint by now.
+                route = ROUTE_PATHS.get(scope.get("endpoint"), "unmatched")
+                HTTP_REQUESTS.inc(route=route, method=scope["method"], status=message["status"])
+                HTTP_SECONDS.observe(time.perf_counter() - started, route=route, method=scope["method"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_metrics)
+
+
+class TraceMiddleware:
+    """Root span and X-Request-ID per request, like tracing.trace_flask."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        handle = begin_request(incoming or None, method=scope["method"], path=scope["path"])
+        request_id = current_request_id().encode("latin-1")
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id)]
+                handle[0].set(status=message["status"], route=ROUTE_PATHS.get(scope.get("endpoint")))
+                # Like Flask's: the root span ends when the response starts.
+                handle[0].finish()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        except Exception as e:
+            end_request(handle, e)
+            raise
+        end_request(handle)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    ytdlp_pool.warm()
+    yield
+    await client.aclose()
+
+
+routes = [
+    Route("/", index),
+    Route("/preview", preview, methods=["POST"]),
+    Route("/download", download, methods=["POST"]),
+    Route("/downloads/{filename}", serve_file),
+    Route("/thumb/{video_id}", thumb),
+    Route("/cache/stats", cache_stats),
+    Route("/metrics", metrics),
+]
+ROUTE_PATHS = {route.endpoint: route.path for route in routes}
+
+stats_gauge("tkdl_metadata_cache", "Metadata cache counters.", metadata_cache.stats,
+            ("size", "hits", "misses", "expired", "evictions", "hit_ratio"))
+GaugeFunc("tkdl_resolves_inflight", "Metadata resolutions in progress.", (), lambda: [((), len(_inflight))])
+
+async def rate_limited(request, error):
+    return JSONResponse({"error": "Too many requests, please slow down."}, status_code=429,
+                        headers={"Retry-After": str(error.retry_after)})
+
+
+async def superseded(request, error):
+    return JSONResponse({"error": str(error)}, status_code=409)
+
+
+app = Starlette(routes=routes, lifespan=lifespan,
+                exception_handlers={RateLimited: rate_limited, Superseded: superseded})
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TraceMiddleware)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=int(os.environ.get("PORT", "5000")))
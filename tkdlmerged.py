@@ -1,9 +1,16 @@
-from flask import Flask, request, jsonify, send_file, render_template_string
-import yt_dlp
+from flask import request, jsonify, send_file, render_template_string, redirect, url_for
 import tempfile
-import os
+from streaming import STREAM_DOWNLOADS, stream_url
+from metacache import video_id_from_url
+from providers import sanitize_url, video_info, fetch_video, forget_info
+from scheduler import download_scheduler, client_id, busy_response, QueueFull
+from webapp import create_app, prefetched_download
+from previews import Superseded, preview_info, preview_session, superseded_response
+from expiry import file_expiry
+from thumbs import thumb_link
 
-app = Flask(__name__)
+# Video cache, /downloads, /cache/stats, /jobs and /batch (see webapp.py)
+app = create_app(__name__)
 
 # ---- Inline frontend (index.html inside Python) ----
 INDEX_HTML = """
@@ -101,15 +108,21 @@ INDEX_HTML = """
       document.body.classList.toggle("dark");
     });
 
-    // Fetch preview
+    // Fetch preview; a newer one aborts the one still in flight
+    let previewRequest;
+    // Names this page to the server, so only its own newer previews supersede its older ones
+    const previewSession = Math.random().toString(36).slice(2) + Date.now().toString(36);
     async function fetchPreview() {
       if (!urlField.value) return;
+      if (previewRequest) previewRequest.abort();
+      const request = previewRequest = new AbortController();
       spinner.style.display = "block";
       previewContainer.innerHTML = "";
       try {
         const res = await fetch("/preview", {
-          method: "POST", headers: {"Content-Type": "application/json"},
-          body: JSON.stringify({url: urlField.value})
+          method: "POST", headers: {"Content-Type": "application/json", "X-Preview-Session": previewSession},
+          body: JSON.stringify({url: urlField.value}),
+          signal: request.signal
         });
         const data = await res.json();
         spinner.style.display = "none";
@@ -121,6 +134,7 @@ INDEX_HTML = """
           ? `<img src="${data.thumbnail}">`
           : `<video src="${data.url}" controls muted></video>`;
       } catch (err) {
+        if (err.name === "AbortError") return;
         spinner.style.display = "none";
         previewContainer.innerHTML = "<p style='color:red'>Could not load preview.</p>";
       }
@@ -150,24 +164,20 @@ INDEX_HTML = """
 
 # ---- Backend logic ----
 
-def extract_video_info(url):
-    ydl_opts = {
-        "quiet": True,
-        "skip_download": True,
+def extract_video_info(url, preview=False):
+    url = sanitize_url(url)
+    if url and preview:
+        info = preview_info(url, preview_session(request))  # see previews.py
+    else:
+        info = video_info(url) if url else None
+    if not info:
+        raise Exception("Could not extract video")
+    return {
+        "title": info.get("title"),
+        "thumbnail": thumb_link(url, info),
+        "url": info["video_url"],
+        "headers": info.get("headers"),
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        formats = info.get("formats", [])
-        video_url = None
-        for f in formats:
-            if f.get("ext") == "mp4" and f.get("url"):
-                video_url = f["url"]
-                break
-        return {
-            "title": info.get("title"),
-            "thumbnail": info.get("thumbnail"),
-            "url": video_url
-        }
 
 @app.route("/")
 def home():
@@ -178,8 +188,11 @@ def preview():
     data = request.get_json()
     url = data.get("url", "")
     try:
-        info = extract_video_info(url)
+        info = extract_video_info(url, preview=True)
+        info.pop("headers", None)
         return jsonify(info)
+    except Superseded as e:
+        return superseded_response(e)
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -187,21 +200,38 @@ def preview():
 def download():
     data = request.get_json()
     url = data.get("url", "")
+    # Already on disk if /preview fetched it in the background (see prefetch.py)
+    filename = prefetched_download(app, sanitize_url(url))
+    if filename:
+        return redirect(url_for("serve_file", filename=filename))
+    if STREAM_DOWNLOADS:
+        return stream_download(url)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
+        tmp_path = tmp.name
+    # Due at once, but held until the response has finished sending it
+    file_expiry.acquire(tmp_path)
+    file_expiry.schedule(tmp_path, 0)
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
-            tmp_path = tmp.name
-        ydl_opts = {
-            "quiet": True,
-            "outtmpl": tmp_path
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        return send_file(tmp_path, as_attachment=True, download_name="tiktok.mp4")
+        download_scheduler.run(client_id(request), fetch_video, sanitize_url(url), tmp_path)
+        response = send_file(tmp_path, as_attachment=True, download_name="tiktok.mp4")
+    except QueueFull as e:
+        file_expiry.release(tmp_path)
+        return busy_response(e)
+    except Exception as e:
+        file_expiry.release(tmp_path)
+        return jsonify({"error": str(e)})
+    return file_expiry.release_with(response, tmp_path)
+
+def stream_download(url):
+    """Relay the resolved video straight from the CDN."""
+    try:
+        info = extract_video_info(url)
+        return stream_url(info["url"], download_name="tiktok.mp4",
+                          etag=video_id_from_url(url), headers=info["headers"])
     except Exception as e:
+        # Probably an expired signed link; resolve again next time.
+        forget_info(sanitize_url(url))
         return jsonify({"error": str(e)})
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,208 @@
+"""
+Per-request tracing: every request gets an ID (X-Request-ID, taken from
+the client if it sent one) and the stages it goes through — provider
+calls, queue wait, CDN fetch, relay, send_file — are recorded as spans
+carrying that ID. Finished spans are logged as JSON lines and, with
+TKDL_TRACE_FILE set, appended to that file as well.
+
+    python tracing.py trace.jsonl      # slowest requests, broken down by stage
+
+Work handed to other threads (resolver pool, download scheduler) keeps
+the request's trace as long as it is submitted with `in_context`.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Log each finished span as a JSON line on stdout (TKDL_TRACE_LOG=0 to stop).
+LOG_SPANS = os.environ.get("TKDL_TRACE_LOG", "1") != "0"
+TRACE_FILE = os.environ.get("TKDL_TRACE_FILE")
+REQUEST_ID_HEADER = "X-Request-ID"
+
+_trace = contextvars.ContextVar("tkdl_trace", default=None)
+_span = contextvars.ContextVar("tkdl_span", default=None)
+_file_lock = threading.Lock()
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id():
+    return _trace.get()
+
+
+def emit(record):
+    line = json.dumps(record, default=str)
+    if LOG_SPANS:
+        print(line)
+    if TRACE_FILE:
+        with _file_lock, open(TRACE_FILE, "a") as f:
+            f.write(line + "\n")
+
+
+class Span:
+    """One timed stage of a request. finish() logs it."""
+
+    def __init__(self, request_id, name, parent, attrs):
+        self.request_id = request_id
+        self.name = name
+        self.id = uuid.uuid4().hex[:8]
+        self.parent = parent
+        self.attrs = attrs
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        self.finished = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        record = {
+            "ts": round(self.wall, 6),
+            "request_id": self.request_id,
+            "span": self.name,
+            "span_id": self.id,
+            "parent_id": self.parent,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "status": "error" if error else "ok",
+        }
+        if error:
+            record["error"] = str(error)
+        record.update(self.attrs)
+        emit(record)
+
+
+class _NoSpan:
+    """Stand-in outside a traced request, so call sites need no checks."""
+
+    id = None
+
+    def set(self, **attrs):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+
+def start_span(name, **attrs):
+    """
+    Start a span under the current one without making it current; for
+    stages that end somewhere else, e.g. a response body streamed after
+    the view returned. Call finish() on it.
+    """
+    request_id = _trace.get()
+    if request_id is None:
+        return _NoSpan()
+    return Span(request_id, name, _span.get(), attrs)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the block as a child of the current span; yields it for set()."""
+    current = start_span(name, **attrs)
+    token = _span.set(current.id) if current.id else None
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(error=e)
+        raise
+    finally:
+        if token is not None:
+            _span.reset(token)
+        current.finish()
+
+
+def record_span(name, seconds, **attrs):
+    """Log a stage that already happened (e.g. time spent queued)."""
+    current = start_span(name, **attrs)
+    if current.id:
+        current.started -= seconds
+        current.wall -= seconds
+        current.finish()
+
+
+def begin_request(request_id, **attrs):
+    """Start the root span of a request; returns a handle for end_request()."""
+    tokens = (_trace.set(request_id or new_request_id()),)
+    root = start_span("request", **attrs)
+    return root, tokens + (_span.set(root.id),)
+
+
+def end_request(handle, error=None):
+    root, (trace_token, span_token) = handle
+    root.finish(error)
+    _span.reset(span_token)
+    _trace.reset(trace_token)
+
+
+def in_context(fn):
+    """Bind `fn` to the current trace, for running it on another thread."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+def trace_flask(app):
+    """Give every request of `app` a root span and an X-Request-ID."""
+    from flask import g, request
+
+    @app.before_request
+    def _begin_trace():
+        g.trace = begin_request(
+            request.headers.get(REQUEST_ID_HEADER),
+            method=request.method, path=request.path,
+        )
+
+    @app.after_request
+    def _tag_response(response):
+        handle = g.get("trace")
+        if handle:
+            handle[0].set(status=response.status_code,
+                          route=request.url_rule.rule if request.url_rule else None)
+            response.headers[REQUEST_ID_HEADER] = _trace.get()
+        return response
+
+    @app.teardown_request
+    def _end_trace(error=None):
+        handle = g.pop("trace", None)
+        if handle:
+            end_request(handle, error)
+
+
+# -------- Offline report -------- #
+
+def report(path, top=10):
+    """Print the slowest requests in a trace file with their stage timings."""
+    spans = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                spans.setdefault(record["request_id"], []).append(record)
+
+    def total(records):
+        roots = [r for r in records if r["span"] == "request"]
+        return max((r["duration_ms"] for r in roots or records), default=0)
+
+    for request_id, records in sorted(spans.items(), key=lambda kv: -total(kv[1]))[:top]:
+        root = next((r for r in records if r["span"] == "request"), {})
+        print(f"{request_id}  {total(records):9.1f} ms  {root.get('method', '')} {root.get('path', '')}")
+        for r in sorted(records, key=lambda r: r["ts"]):
+            if r["span"] == "request":
+                continue
+            extra = " ".join(f"{k}={r[k]}" for k in ("provider", "outcome", "bytes") if k in r)
+            print(f"    {r['span']:<16}{r['duration_ms']:9.1f} ms  {r['status']:<5} {extra}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python tracing.py TRACE_FILE [TOP]")
+    report(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,377 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from expiry import file_expiry
+from metacache import video_id_from_url
+from shared import STATE_DB, connect, pid_alive, transaction
+
+# Total bytes of video kept on disk before the least recently used files go.
+DEFAULT_MAX_BYTES = int(os.environ.get("TKDL_CACHE_BYTES", 2 * 1024 ** 3))
+TEMP_SUFFIX = ".part"
+
+
+def cache_name(url: str, fmt="mp4") -> str:
+    """
+    On-disk name for `url`: `<video id>.<fmt>`, so every link to the same
+    video shares one file. URLs without a recognisable ID fall back to a
+    hash of the URL.
+    """
+    key = video_id_from_url(url)
+    if not key:
+        key = "u" + hashlib.sha1((url or "").strip().encode()).hexdigest()[:20]
+    return f"{key}.{fmt}"
+
+
+class FillCancelled(Exception):
+    """A fill that gave up on purpose: waiters download it themselves instead."""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class VideoCache:
+    """
+    Size-bounded LRU cache of downloaded videos in `folder`.
+
+    Files are written under a temporary name and renamed into place, so a
+    reader never sees a partial video. Concurrent requests for the same
+    uncached video wait on the first one's download instead of starting
+    their own. Files are deleted through `expiry`, so one that a response
+    is still sending (leased there) stays until a later eviction.
+    """
+
+    def __init__(self, folder, max_bytes=DEFAULT_MAX_BYTES, expiry=file_expiry):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self._files = OrderedDict()  # name -> size, oldest access first
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if not os.path.isfile(path):
+                continue
+            if name.startswith("."):
+                # Temporary file left behind by a crash mid-download.
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            entries.append((max(st.st_atime, st.st_mtime), name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+        with self._lock:
+            self._evict()
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    @property
+    def total_bytes(self):
+        return sum(self._files.values())
+
+    def get(self, name):
+        """Return `name` if it is cached (marking it recently used), else None."""
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        try:
+            os.utime(self.path(name))
+        except OSError:
+            pass
+        return name
+
+    def fetch(self, name, fill):
+        """
+        Return `name`, downloading it first if needed.
+
+        `fill(tmp_path)` must write the video to `tmp_path` and return a
+        truthy value (or raise) on failure. Only one fill runs per name at a
+        time; other callers block until it finishes and share its outcome,
+        unless it raised FillCancelled, in which case one of them takes over.
+        """
+        with self._lock:
+            if name in self._files and not os.path.exists(self.path(name)):
+                # Deleted behind our back (e.g. by an external cleanup job).
+                del self._files[name]
+            if name in self._files:
+                self._files.move_to_end(name)
+                self.hits += 1
+                return name
+            flight = self._inflight.get(name)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[name] = _Flight()
+                self.misses += 1
+
+        if not leader:
+            flight.done.wait()
+            if isinstance(flight.error, FillCancelled):
+                return self.fetch(name, fill)
+            if flight.error:
+                raise flight.error
+            return name
+
+        tmp = self.path(f".{name}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+        try:
+            if not fill(tmp) or not os.path.exists(tmp):
+                raise RuntimeError(f"could not download {name}")
+            os.replace(tmp, self.path(name))
+            size = os.path.getsize(self.path(name))
+            with self._lock:
+                self._files[name] = size
+                self._files.move_to_end(name)
+                self._evict()
+            return name
+        except Exception as e:
+            flight.error = e
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(name, None)
+            flight.done.set()
+
+    def discard(self, name):
+        """Remove `name` from the cache; False if it wasn't there or is being sent."""
+        with self._lock:
+            if name not in self._files or not self.expiry.remove_unleased([self.path(name)]):
+                return False
+            del self._files[name]
+        return True
+
+    def _evict(self):
+        # Caller holds self._lock. Never evict the newest entry, even if it
+        # alone is over budget - it is about to be served. Leased files are
+        # skipped; the next eviction tries them again.
+        excess = self.total_bytes - self.max_bytes
+        if excess > 0:
+            for name in self._remove_oldest(list(self._files.items())[:-1], excess):
+                del self._files[name]
+
+    def _remove_oldest(self, entries, excess):
+        """
+        Delete files from `entries` ((name, size), oldest first) until
+        `excess` bytes are gone, skipping leased ones. Returns the names.
+        """
+        removed = []
+        entries = iter(entries)
+        while excess > 0:
+            batch = []
+            for name, size in entries:
+                batch.append((name, size))
+                excess -= size
+                if excess <= 0:
+                    break
+            if not batch:
+                break
+            sizes = dict(batch)
+            for path in self.expiry.remove_unleased([self.path(name) for name, _ in batch]):
+                name = os.path.basename(path)
+                removed.append(name)
+                sizes.pop(name)
+                self.evictions += 1
+                print(f"[Cache] Evicted {name}")
+            excess += sum(sizes.values())  # leased: still there
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "inflight": len(self._inflight),
+            }
+
+
+class SharedVideoCache(VideoCache):
+    """
+    VideoCache whose index and in-flight downloads live in a SQLite file
+    (see shared.py), so worker processes using the same folder share hits,
+    the byte budget and the one-download-per-video rule.
+
+    A process that finds another one already downloading a video polls
+    until the file is in the index. A failed download is reported to the
+    callers that were already waiting for it; later ones (and the waiters
+    of a FillCancelled one) start a new download, as does a caller finding
+    a download whose process died.
+    """
+
+    POLL_SECONDS = 0.1
+    STALE_FILL_SECONDS = 900
+
+    def __init__(self, folder, db_path, max_bytes=DEFAULT_MAX_BYTES, expiry=file_expiry):
+        self.db_path = db_path
+        self.folder_key = os.path.abspath(folder)
+        super().__init__(folder, max_bytes, expiry)
+
+    def _load(self):
+        db = connect(self.db_path)
+        db.execute("CREATE TABLE IF NOT EXISTS cache_files (folder TEXT, name TEXT, size INTEGER,"
+                   " used REAL, PRIMARY KEY (folder, name))")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_files_used ON cache_files (folder, used)")
+        db.execute("CREATE TABLE IF NOT EXISTS cache_fills (folder TEXT, name TEXT, pid INTEGER,"
+                   " started REAL, error TEXT, PRIMARY KEY (folder, name))")
+        now = time.time()
+        found = {}
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            if name.startswith("."):
+                # Another worker may be writing it right now; only old ones are leftovers.
+                if now - st.st_mtime > self.STALE_FILL_SECONDS:
+                    os.remove(path)
+                continue
+            found[name] = (st.st_size, max(st.st_atime, st.st_mtime))
+        with transaction(self.db_path) as db:
+            known = {name for (name,) in db.execute(
+                "SELECT name FROM cache_files WHERE folder = ?", (self.folder_key,))}
+            for name in known - found.keys():
+                db.execute("DELETE FROM cache_files WHERE folder = ? AND name = ?", (self.folder_key, name))
+            for name in found.keys() - known:
+                db.execute("INSERT INTO cache_files VALUES (?, ?, ?, ?)", (self.folder_key, name, *found[name]))
+            doomed, excess = self._evict_rows(db, keep=None)
+        self._remove_files(doomed, excess)
+
+    def get(self, name):
+        cur = connect(self.db_path).execute(
+            "UPDATE cache_files SET used = ? WHERE folder = ? AND name = ?",
+            (time.time(), self.folder_key, name))
+        return name if cur.rowcount else None
+
+    def _claim(self, name, since):
+        """
+        'hit', 'leader', or None to keep waiting; the leader's error if it
+        failed after `since` (when this caller started waiting).
+        """
+        now = time.time()
+        with transaction(self.db_path) as db:
+            if db.execute("SELECT 1 FROM cache_files WHERE folder = ? AND name = ?",
+                          (self.folder_key, name)).fetchone():
+                if os.path.exists(self.path(name)):
+                    db.execute("UPDATE cache_files SET used = ? WHERE folder = ? AND name = ?",
+                               (now, self.folder_key, name))
+                    return "hit"
+                db.execute("DELETE FROM cache_files WHERE folder = ? AND name = ?", (self.folder_key, name))
+            fill = db.execute("SELECT pid, started, error FROM cache_fills WHERE folder = ? AND name = ?",
+                              (self.folder_key, name)).fetchone()
+            if fill:
+                pid, started, error = fill
+                if error and started >= since:
+                    return RuntimeError(error)
+                if not error and pid_alive(pid) and now - started < self.STALE_FILL_SECONDS:
+                    return None
+            db.execute("INSERT OR REPLACE INTO cache_fills VALUES (?, ?, ?, ?, NULL)",
+                       (self.folder_key, name, os.getpid(), now))
+            return "leader"
+
+    def fetch(self, name, fill):
+        since = time.time()
+        while True:
+            claim = self._claim(name, since)
+            if claim == "hit":
+                self.hits += 1
+                return name
+            if claim == "leader":
+                break
+            if isinstance(claim, Exception):
+                raise claim
+            time.sleep(self.POLL_SECONDS)
+
+        self.misses += 1
+        tmp = self.path(f".{name}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+        try:
+            if not fill(tmp) or not os.path.exists(tmp):
+                raise RuntimeError(f"could not download {name}")
+            os.replace(tmp, self.path(name))
+            size = os.path.getsize(self.path(name))
+        except Exception as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if isinstance(e, FillCancelled):
+                connect(self.db_path).execute("DELETE FROM cache_fills WHERE folder = ? AND name = ?",
+                                              (self.folder_key, name))
+            else:
+                connect(self.db_path).execute(
+                    "UPDATE cache_fills SET error = ?, started = ? WHERE folder = ? AND name = ?",
+                    (str(e) or type(e).__name__, time.time(), self.folder_key, name))
+            raise
+        with transaction(self.db_path) as db:
+            db.execute("INSERT OR REPLACE INTO cache_files VALUES (?, ?, ?, ?)",
+                       (self.folder_key, name, size, time.time()))
+            db.execute("DELETE FROM cache_fills WHERE folder = ? AND name = ?", (self.folder_key, name))
+            doomed, excess = self._evict_rows(db, keep=name)
+        self._remove_files(doomed, excess)
+        return name
+
+    def discard(self, name):
+        db = connect(self.db_path)
+        if not db.execute("SELECT 1 FROM cache_files WHERE folder = ? AND name = ?",
+                          (self.folder_key, name)).fetchone():
+            return False
+        if not self.expiry.remove_unleased([self.path(name)]):
+            return False
+        db.execute("DELETE FROM cache_files WHERE folder = ? AND name = ?", (self.folder_key, name))
+        return True
+
+    def _evict_rows(self, db, keep):
+        """Entries that may be evicted, oldest use first, and the bytes over budget."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM cache_files WHERE folder = ?",
+                           (self.folder_key,)).fetchone()[0]
+        if total <= self.max_bytes:
+            return [], 0
+        rows = db.execute("SELECT name, size FROM cache_files WHERE folder = ? ORDER BY used",
+                          (self.folder_key,)).fetchall()
+        return [(name, size) for name, size in rows if name != keep], total - self.max_bytes
+
+    def _remove_files(self, entries, excess):
+        # After the index transaction: the expiry index takes its own. Leased
+        # files keep their rows and are tried again at the next eviction.
+        removed = self._remove_oldest(entries, excess)
+        connect(self.db_path).executemany("DELETE FROM cache_files WHERE folder = ? AND name = ?",
+                                          [(self.folder_key, name) for name in removed])
+
+    def stats(self):
+        db = connect(self.db_path)
+        files, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_files WHERE folder = ?",
+                                  (self.folder_key,)).fetchone()
+        inflight = db.execute("SELECT COUNT(*) FROM cache_fills WHERE folder = ? AND error IS NULL",
+                              (self.folder_key,)).fetchone()[0]
+        return {
+            "files": files,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "inflight": inflight,
+        }
+
+
+def open_cache(folder, max_bytes=DEFAULT_MAX_BYTES):
+    """The cache for `folder`: shared between processes when TKDL_STATE_DB is set."""
+    if STATE_DB:
+        return SharedVideoCache(folder, STATE_DB, max_bytes)
+    return VideoCache(folder, max_bytes)
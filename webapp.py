@@ -0,0 +1,141 @@
+import os
+
+from flask import Flask, jsonify
+from werkzeug.security import safe_join
+
+import providers
+from canonical import short_links
+from batch import batch_blueprint
+from expiry import file_expiry
+from httppool import http_session
+from jobs import jobs_blueprint, job_table
+from metacache import metadata_cache
+from metrics import GaugeFunc, instrument_flask, stats_gauge
+from prefetch import open_prefetcher, prefetch_flask
+from previews import preview_lookups
+from ratelimit import limit_flask, stats as ratelimit_stats
+from tracing import span, trace_flask
+from scheduler import QueueFull, download_scheduler
+from streaming import send_download
+from thumbs import thumb_cache, thumbs_blueprint
+from videocache import cache_name, open_cache
+from ytdlp_worker import ytdlp_pool
+
+
+def create_app(import_name, download_folder="static/downloads"):
+    """
+    Flask app with the pieces every entry point shares: the video cache
+    in `download_folder` (relative to the app), /downloads/<filename>,
+    /cache/stats, /metrics, /thumb, the /jobs and /batch APIs, a warm yt-dlp
+    pool and, with TKDL_PREFETCH=1, background fetches of previewed videos.
+    Scripts add their own page, /preview and /download routes on top,
+    using `cached_download` and the helpers in providers.py.
+    """
+    app = Flask(import_name)
+    folder = os.path.join(app.root_path, download_folder)
+    os.makedirs(folder, exist_ok=True)
+    app.config["DOWNLOAD_FOLDER"] = folder
+    # One file per video, evicted least-recently-used when over budget
+    # (index shared by all worker processes under serve.py).
+    video_cache = app.extensions["video_cache"] = open_cache(folder)
+    # Previewed videos fetched ahead of their download (see prefetch.py)
+    prefetcher = app.extensions["prefetch"] = open_prefetcher(video_cache)
+
+    def download_job(url, progress, client):
+        return cached_download(app, url, client=client, progress=progress)
+
+    def download_path(url):
+        return video_cache.path(cached_download(app, url))
+
+    @app.route("/downloads/<path:filename>")
+    def serve_file(filename):
+        path = safe_join(folder, filename)
+        if path is None:
+            return send_download(folder, filename)  # 404
+        # Not deleted by the expiry index while this response is sending it.
+        file_expiry.acquire(path)
+        try:
+            response = send_download(folder, filename)
+        except Exception:
+            file_expiry.release(path)
+            raise
+        return file_expiry.release_with(response, path)
+
+    @app.route("/cache/stats")
+    def cache_stats():
+        return jsonify({
+            "metadata": metadata_cache.stats(),
+            "videos": video_cache.stats(),
+            "resolvers": providers.stats(),
+            "http": http_session.pool_stats(),
+            "yt-dlp": ytdlp_pool.stats(),
+            "scheduler": download_scheduler.stats(),
+            "jobs": job_table.stats(),
+            "thumbs": thumb_cache.stats(),
+            "short_links": short_links.stats(),
+            "rate_limits": ratelimit_stats(),
+            "prefetch": prefetcher.stats(),
+            "previews": preview_lookups.stats(),
+        })
+
+    instrument_flask(app)
+    trace_flask(app)
+    limit_flask(app)
+    prefetch_flask(app)
+    stats_gauge("tkdl_metadata_cache", "Metadata cache counters.", metadata_cache.stats,
+                ("size", "hits", "misses", "expired", "evictions", "hit_ratio"))
+    stats_gauge("tkdl_video_cache", "Video file cache counters.", video_cache.stats,
+                ("files", "bytes", "max_bytes", "hits", "misses", "evictions", "inflight"))
+    stats_gauge("tkdl_scheduler", "Download worker pool: active downloads and queue depth.",
+                download_scheduler.stats,
+                ("workers", "running", "queued", "clients_waiting", "completed", "rejected", "avg_seconds"))
+    stats_gauge("tkdl_thumb_cache", "Cover image cache counters.", thumb_cache.stats,
+                ("files", "bytes", "hits", "misses", "evictions", "memory_items", "memory_hits", "upstream_fetches"))
+    stats_gauge("tkdl_prefetch", "Background fetches of previewed videos.", prefetcher.stats,
+                ("active", "waiting", "pending_bytes"))
+    GaugeFunc("tkdl_jobs", "Jobs in the job table by status.", ("status",),
+              lambda: [((status,), n) for status, n in job_table.stats().items()])
+
+    # Async downloads: POST /jobs, poll or stream progress, fetch via serve_file
+    app.register_blueprint(jobs_blueprint(download_job, sanitize=providers.sanitize_url))
+    # Several URLs at once, streamed back as a ZIP
+    app.register_blueprint(batch_blueprint(download_path, sanitize=providers.sanitize_url))
+    # /thumb/<video_id>: cached, resized covers for the previews
+    app.register_blueprint(thumbs_blueprint())
+
+    ytdlp_pool.warm()
+    return app
+
+
+def cached_download(app, url, client=None, progress=None):
+    """
+    Filename of `url` in the app's video cache, downloading it on a miss.
+    With `client`, the download waits its turn on the shared scheduler
+    (and may raise QueueFull); cache hits never queue.
+    """
+    def fill(filepath):
+        with span("cache_fill"):
+            if client is None:
+                return providers.fetch_video(url, filepath, progress)
+            return download_scheduler.run(client, providers.fetch_video, url, filepath, progress)
+
+    cache = app.extensions["video_cache"]
+    if app.extensions["prefetch"].claim(url):
+        # Join the background fetch /preview started, or use what it saved.
+        try:
+            return cache.fetch(cache_name(url), fill)
+        except QueueFull:
+            raise
+        except Exception as e:
+            print(f"[Prefetch] {cache_name(url)} failed ({e}), downloading it again")
+    return cache.fetch(cache_name(url), fill)
+
+
+def prefetched_download(app, url):
+    """
+    Filename of `url` in the app's video cache when it is there, e.g.
+    fetched in the background by /preview (waiting for that fetch if it
+    is still running); None if not. For scripts whose downloads otherwise
+    don't go through the cache.
+    """
+    return app.extensions["prefetch"].take(url)
@@ -0,0 +1,111 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from yt_dlp import YoutubeDL
+
+from tracing import span
+
+COOKIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookies.txt")
+POOL_SIZE = int(os.environ.get("TKDL_YTDLP_WORKERS", "2"))
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+)
+
+
+class YtDlpPool:
+    """
+    A few long-lived YoutubeDL instances, handed out one thread at a time.
+
+    Spawning the yt-dlp CLI (or building a YoutubeDL) per request pays for
+    interpreter start-up, extractor imports and cookie parsing every time.
+    Here that happens once per instance; extraction then costs only the
+    network round trips, and the video bytes go through the shared HTTP
+    pool like every other provider.
+    """
+
+    def __init__(self, size=POOL_SIZE, cookies_file=COOKIES_FILE):
+        self.size = size
+        self.cookies_file = cookies_file
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_instance(self, use_cookies=True):
+        opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "skip_download": True,
+            "format": "best[ext=mp4]/best",
+            "http_headers": {"User-Agent": USER_AGENT},
+        }
+        if use_cookies and self.cookies_file and os.path.exists(self.cookies_file):
+            opts["cookiefile"] = self.cookies_file
+        ydl = YoutubeDL(opts)
+        # Parse the cookie file and import the TikTok extractor now rather
+        # than on the first request.
+        try:
+            ydl.cookiejar.get_cookie_header("https://www.tiktok.com/")
+        except Exception as e:
+            if "cookiefile" not in opts:
+                raise
+            print(f"[yt-dlp] ignoring unreadable {self.cookies_file}: {e}")
+            return self._new_instance(use_cookies=False)
+        ydl.get_info_extractor("TikTok")
+        return ydl
+
+    @contextmanager
+    def instance(self):
+        try:
+            ydl = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    ydl = self._new_instance()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                ydl = self._idle.get()
+        try:
+            yield ydl
+        finally:
+            self._idle.put(ydl)
+
+    def warm(self):
+        """Build every instance in the background so the first request is fast."""
+        def run():
+            with self._lock:
+                missing = self.size - self._created
+                self._created = self.size
+            for _ in range(missing):
+                try:
+                    self._idle.put(self._new_instance())
+                except Exception as e:
+                    with self._lock:
+                        self._created -= 1
+                    print(f"[yt-dlp warm-up error] {e}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def extract(self, url):
+        """Metadata for `url` (yt-dlp's info dict, with the chosen format merged in)."""
+        with span("ytdlp_extract"), self.instance() as ydl:
+            info = ydl.extract_info(url, download=False)
+            info = ydl.sanitize_info(info)
+            if info.get("url"):
+                info["cookie_header"] = ydl.cookiejar.get_cookie_header(info["url"])
+            return info
+
+    def stats(self):
+        return {"size": self.size, "created": self._created, "idle": self._idle.qsize()}
+
+
+ytdlp_pool = YtDlpPool()